@@ -1,9 +1,11 @@
 import os
 import sys
+from functools import cached_property
+from concurrent import futures
 
 import settings
 from objects import Crawl
-from helpers import select_processes, logg
+from helpers import select_processes, logg, http_client
 
 
 all_processes = [x.replace('.py', '') for x in os.listdir(os.path.join(settings.root, 'processes')) if x.endswith('.py')]
@@ -11,10 +13,61 @@ for process in all_processes:
     exec(f'from processes import {process}')
 
 
+def conflicts(a, b) -> bool:
+    '''Whether sub-process modules a and b must not run at the same time: one sets a Crawl attribute which the other
+    reads or sets (see processes/template.py). 'crawl' stands for every attribute. A module which does not declare
+    its inputs and outputs conflicts with all others.'''
+    def clash(names: tuple, attributes: tuple) -> bool:
+        return bool(attributes) and ('crawl' in names or 'crawl' in attributes or bool(set(names) & set(attributes)))
+    a_inputs, a_outputs = getattr(a, 'inputs', ('crawl',)), getattr(a, 'outputs', ('crawl',))
+    b_inputs, b_outputs = getattr(b, 'inputs', ('crawl',)), getattr(b, 'outputs', ('crawl',))
+    return clash(a_inputs + a_outputs, b_outputs) or clash(b_inputs + b_outputs, a_outputs)
+
+
+def run_processes(crawl, to_run: list, logger) -> list:
+    '''Runs the sub-processes in to_run on crawl, up to settings.subprocess_concurrency at once. Each starts once no
+    conflicting process (see conflicts) is running or waiting before it in to_run, so dependent ones keep their order.
+    Crawl attributes read by more than one process are loaded first, so threads do not build them twice.
+    If a process fails, the exception is relayed to the JIRA issue and the others carry on.
+    Returns the processes which failed.'''
+    modules = {process: globals()[process] for process in to_run}
+    inputs = [name for process in to_run for name in getattr(modules[process], 'inputs', ())]
+    for name in dict.fromkeys(inputs):
+        if inputs.count(name) > 1 and isinstance(getattr(type(crawl), name, None), cached_property):
+            getattr(crawl, name)
+
+    failed_processes = []
+    waiting = list(to_run)
+    running = {}
+    with futures.ThreadPoolExecutor(max_workers=settings.subprocess_concurrency) as executor:
+        while waiting or running:
+            for process in list(waiting):
+                if len(running) >= settings.subprocess_concurrency:
+                    break
+                before = waiting[:waiting.index(process)] + list(running.values())
+                if any(conflicts(modules[process], modules[other]) for other in before):
+                    continue
+                logger.info(f'Initiating {process}')
+                running[executor.submit(getattr(modules[process], process), crawl)] = process
+                waiting.remove(process)
+
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                process = running.pop(future)
+                try:
+                    future.result()
+                    logger.info(f'Process {process} complete.')
+                except Exception as e:
+                    crawl.issue.add_comment(f'{process} failed:\n{repr(e)}')
+                    logger.exception(f'Process {process} Errored. Moving onto next process.')
+                    failed_processes.append(process)
+    return failed_processes
+
+
 def autoQA(crawl_id: int):
     '''Takes a crawl ID and runs autoQA on it. a Crawl object is created which bundles all a crawl's realted metdata
     i.e. jira issue, crawl logs/specification etc. The select processes module produces a list of sub-processes to run
-    which are run in turn.
+    which are run concurrently where they do not depend on each other (see run_processes).
     If a process fails, the exception is caught and relayed to the JIRA issue.'''
 
     # Configures logger
@@ -45,24 +98,17 @@ def autoQA(crawl_id: int):
         crawl.directory = crawl_dir
         logger.info('Crawl loaded.')
         try:
-            # Runs each process in turn added a comment to the issue before, after each process and at the end of the whole autoQA process.
+            # Runs the processes, adding a comment to the issue before, on each failure and at the end of the whole autoQA process.
             logger.info(f'To run: {to_run}')
             crawl.issue.add_comment(f'autoQA starting.\nautoQA will run: {to_run}')
-            failed_processes = []
-            for process in to_run:
-                try:
-                    logger.info(f'Initiating {process}')
-                    exec(f'{process}.{process}(crawl)')
-                    logger.info(f'Process {process} complete.')
-                except Exception as e:
-                    crawl.issue.add_comment(f'{process} failed:\n{repr(e)}')
-                    logger.exception(f'Process {process} Errored. Moving onto next process.')
-                    failed_processes.append(process)
+            failed_processes = run_processes(crawl, to_run, logger)
 
             successful_processes = [process for process in to_run if process not in failed_processes]
 
             logger.info(f'autoQA Finished. Successful Processes: {successful_processes}. Failed Processes: {failed_processes}')
             crawl.issue.add_comment(f'autoQA Finished.\nSuccessful Processes: {successful_processes}.\nFailed Processes: {failed_processes}')
+            logger.info(f'S3 cache: {crawl.cache.stats()}.')
+            logger.info(f'HTTP endpoints:\n{http_client.stats()}')
 
         except Exception as e:
             crawl.issue.add_comment(f'autoQA failed:\n{repr(e)}')
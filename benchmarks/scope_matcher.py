@@ -0,0 +1,57 @@
+'''Micro-benchmark comparing ScopeMatcher with the loops PDFflash used to check scope.
+Run from the repository root: python3 -m benchmarks.scope_matcher [n_rules] [n_urls]'''
+import sys
+import time
+import random
+import re
+from urllib.parse import urlparse
+
+from objects.ScopeMatcher import ScopeMatcher
+
+url_clean_regex = re.compile('^(?:.?https?:\/\/)?(?:www\.)?(.*?)/?$')
+
+
+def clean_url(url: str):
+    return url_clean_regex.sub(r'\1', url)
+
+
+def loop_match(url, scope_slds, scope_prefixes):
+    '''The previous PDFflash scope check.'''
+    if any([domain in urlparse(url).netloc for domain in scope_slds]):
+        return True
+    return any([clean_url(url).startswith(pattern) for pattern in scope_prefixes])
+
+
+def main(n_rules: int = 5000, n_urls: int = 20000):
+    random.seed(0)
+    words = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(3, 10))) for _ in range(2000)]
+    slds = [f'{random.choice(words)}.{random.choice(["gov.uk", "org.uk", "nhs.uk"])}' for _ in range(n_rules // 5)]
+    domains = [f'{random.choice(words)}.{random.choice(words)}.co.uk' for _ in range(n_rules // 2)]
+    paths = [f'{random.choice(domains)}/{random.choice(words)}' for _ in range(n_rules - len(slds) - len(domains))]
+    hosts = [f'www.{random.choice(slds)}' for _ in range(100)] + domains[:100] + \
+            [f'{random.choice(words)}.com' for _ in range(300)]
+    urls = [f'https://{random.choice(hosts)}/{random.choice(words)}/{random.choice(words)}.html' for _ in range(n_urls)]
+
+    start = time.perf_counter()
+    matcher = ScopeMatcher(slds, domains + paths)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matched = matcher.match_many(urls)
+    trie = time.perf_counter() - start
+
+    sample = urls[:max(1, n_urls // 20)]          # the loops are slow, so time a sample and extrapolate
+    start = time.perf_counter()
+    expected = [loop_match(url, slds, domains + paths) for url in sample]
+    loops = (time.perf_counter() - start) * len(urls) / len(sample)
+
+    assert matched[:len(sample)] == expected, 'ScopeMatcher disagrees with the loops'
+    print(f'{n_rules} rules, {n_urls} URLs ({sum(matched)} in scope)')
+    print(f'build:        {build:.3f}s')
+    print(f'ScopeMatcher: {trie:.3f}s')
+    print(f'loops:        {loops:.3f}s (extrapolated from {len(sample)} URLs)')
+    print(f'speedup:      {loops / trie:.0f}x')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,50 @@
+'''Benchmark comparing URLHashSet with the set of strings diffex holds the crawl log's URLs in.
+Reports build time, membership (diff) time and memory for each.
+Run from the repository root: python3 -m benchmarks.url_sets [n_crawl_urls] [n_sf_urls]'''
+import sys
+import time
+import random
+import tracemalloc
+
+import pandas as pd
+
+from objects.URLHashSet import URLHashSet
+
+
+def measure(build, query):
+    '''Returns (result of query, build seconds, query seconds, peak MB while building, MB retained).
+    Times are taken without tracing, memory from a second, traced build.'''
+    start = time.perf_counter()
+    structure = build()
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    result = query(structure)
+    queried = time.perf_counter() - start
+    del structure
+
+    tracemalloc.start()
+    structure = build()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, built, queried, peak / 1024 ** 2, retained / 1024 ** 2
+
+
+def main(n_crawl_urls: int = 10_000_000, n_sf_urls: int = 1_000_000):
+    random.seed(0)
+    hosts = [f'site{i}.gov.uk' for i in range(500)]
+    keys = pd.Series([f'{random.choice(hosts)}/page/{i}.html' for i in range(n_crawl_urls)], dtype=str)
+    # Screaming Frog finds most crawled URLs and some the crawler did not
+    sf = pd.Series(list(keys.sample(n_sf_urls * 9 // 10, random_state=0)) +
+                   [f'{random.choice(hosts)}/missing/{i}.html' for i in range(n_sf_urls - n_sf_urls * 9 // 10)])
+
+    string_set = measure(lambda: set(keys), lambda urls: sf.isin(urls).to_numpy())
+    hash_set = measure(lambda: URLHashSet(keys), lambda urls: urls.isin(sf))
+
+    assert (string_set[0] == hash_set[0]).all(), 'URLHashSet disagrees with the set'
+    print(f'{n_crawl_urls} crawl log URLs, {n_sf_urls} SF URLs ({(~hash_set[0]).sum()} missing)')
+    for name, (_, built, queried, peak, retained) in (('set', string_set), ('URLHashSet', hash_set)):
+        print(f'{name:10} build {built:6.2f}s  diff {queried:6.2f}s  peak {peak:8.1f} MB  retained {retained:8.1f} MB')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
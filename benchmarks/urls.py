@@ -0,0 +1,60 @@
+'''Benchmark comparing helpers/urls canonicalisation with the per-URL clean_url diffex used.
+Run from the repository root: python3 -m benchmarks.urls [n_urls] (5M by default, as in a large crawl log)'''
+import re
+import sys
+import time
+import random
+from urllib.parse import unquote, quote
+
+import pandas as pd
+
+from helpers import urls
+
+url_clean_regex = re.compile('^(?:.?https?:\/\/)?(?:www\.)?(.*?)/?$')
+
+
+def clean_url(url: str):
+    '''The previous diffex clean_url.'''
+    return quote(unquote(url_clean_regex.sub(r'\1', url)))
+
+
+def main(n_urls: int = 5_000_000):
+    random.seed(0)
+    words = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(3, 10))) for _ in range(5000)]
+    hosts = [f'www.{random.choice(words)}.gov.uk' for _ in range(200)] + [f'{random.choice(words)}.org.uk' for _ in range(200)]
+    extras = ['', '', '', '/', '?page=2', '%20copy', '#section', '?q=a b']
+    n_unique = n_urls * 3 // 5          # crawl logs repeat URLs (redirects, retries, duplicate discovery)
+    unique = [f'{random.choice(["http", "https"])}://{random.choice(hosts)}/{random.choice(words)}/'
+              f'{random.choice(words)}.html{random.choice(extras)}' for _ in range(n_unique)]
+    log = pd.Series(unique + random.choices(unique, k=n_urls - n_unique))
+
+    start = time.perf_counter()
+    expected = set(map(clean_url, log.unique()))
+    old = time.perf_counter() - start
+
+    urls.canonical.cache_clear()
+    urls.requote.cache_clear()
+    start = time.perf_counter()
+    keys = urls.canonical_series(log)
+    new = time.perf_counter() - start
+
+    start = time.perf_counter()
+    unique_keys = set(urls.canonical_series(pd.Series(log.unique())))
+    new_unique = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scalar = [urls.canonical(url) for url in log[:100_000]]
+    cached = time.perf_counter() - start
+
+    assert list(keys[:100_000]) == scalar, 'canonical_series disagrees with canonical'
+    # the canonical key also drops fragments, so it can only merge clean_url's keys
+    print(f'{n_urls} URLs ({len(unique_keys)} unique keys, {len(expected)} with clean_url)')
+    print(f'clean_url (unique, per URL):     {old:.3f}s')
+    print(f'canonical_series (all):          {new:.3f}s')
+    print(f'canonical_series (unique):       {new_unique:.3f}s')
+    print(f'canonical (100k scalar, cached): {cached:.3f}s')
+    print(f'speedup (unique):                {old / new_unique:.1f}x')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,161 @@
+import logging
+import posixpath
+import concurrent.futures
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import settings
+from env import secrets
+from helpers import http_client
+from helpers.urls import canonical
+
+default_logger = logging.getLogger('__main__.cdx')
+paginated = {}      # cdx root: whether the server answers showNumPages (probed once per process)
+
+
+def cdx_get(params: dict, cdx_root: str = settings.qa_cdx_root, stream: bool = False, logger=default_logger):
+    '''Makes a CDX API request through the shared HTTP client (rate limited, retried with backoff and
+    circuit broken as the 'cdx' endpoint). Raises an exception if it does not succeed.'''
+    response = http_client.get(cdx_root, 'cdx', params=params, stream=stream,
+                               auth=(secrets.NOTDuser, secrets.NOTDpassword)) #auth is for if using notd, does not affect other indexes
+    logger.debug(f'{response.url} [{response.status_code}]')
+    if response.status_code != 200:
+        logger.error(f'CDX API call failed. {response.url} [{response.status_code}]')
+        raise Exception(f'CDX API call failed [{response.status_code}]')
+    return response
+
+
+def url_in_cdx_index(url: str, cdx_root: str = settings.qa_cdx_root, logger=default_logger) -> bool:
+    '''Checks the presence of a URL in a CDX index (the UKGWA QA index by default). Returning True or False'''
+    logger.debug(f'Checking {url} in QA index.')
+    return bool(cdx_get({'url': url, 'limit': 1}, cdx_root, logger=logger).text.strip())
+
+
+def prefix_pages(prefix: str, cdx_root: str = settings.qa_cdx_root, logger=default_logger) -> int:
+    '''Returns the number of pages of captures under a URL prefix, or None if the server does not paginate.
+    Only the first line of the answer is read: a server which ignores showNumPages sends the whole prefix result,
+    which is not downloaded. Such a server is remembered and not probed again.'''
+    if paginated.get(cdx_root) is False:
+        return None
+    params = {'url': prefix, 'matchType': 'prefix', 'showNumPages': 'true'}
+    with cdx_get(params, cdx_root, stream=True, logger=logger) as response:
+        first_line = next(response.iter_lines(), b'')
+    try:
+        pages = int(first_line.strip() or 1)
+    except ValueError:      # server does not support pagination
+        paginated[cdx_root] = False
+        return None
+    paginated[cdx_root] = True
+    return pages
+
+
+def query_prefix(prefix: str, cdx_root: str = settings.qa_cdx_root, logger=default_logger, pages: int = None):
+    '''Streams the original URLs of every capture under a URL prefix (matchType=prefix), page by page
+    if the server paginates (pages, see prefix_pages). Yields URL strings.'''
+    params = {'url': prefix, 'matchType': 'prefix', 'fl': 'original'}
+    for page in range(pages) if pages else [None]:
+        page_params = params if page is None else {**params, 'page': page}
+        with cdx_get(page_params, cdx_root, stream=True, logger=logger) as response:
+            for line in response.iter_lines():
+                if line:
+                    yield line.decode(errors='replace').split()[0]
+
+
+def prefix_captured(urls: list, prefix: str, cdx_root: str = settings.qa_cdx_root, logger=default_logger) -> set:
+    '''Answers URLs under prefix with one prefix query, returning the canonical keys of those captured.
+    Returns None without reading further if the prefix is too broad for the number of URLs: more than
+    settings.cdx_bulk_captures_per_url captures each (estimated from the page count if the server paginates),
+    though a single page is always read.'''
+    max_captures = max(len(urls) * settings.cdx_bulk_captures_per_url, settings.cdx_captures_per_page)
+    pages = prefix_pages(prefix, cdx_root, logger)
+    if pages and pages * settings.cdx_captures_per_page > max_captures:
+        return None
+    wanted = {canonical(url) for url in urls}
+    captured = set()
+    for count, original in enumerate(query_prefix(prefix, cdx_root, logger, pages), 1):
+        if count > max_captures:
+            return None
+        key = canonical(original)
+        if key in wanted:
+            captured.add(key)
+    return captured
+
+
+def split_by_directory(urls: list, prefix: str) -> dict:
+    '''Groups URLs under prefix by the directory below it (e.g. host/docs/ for host/). URLs directly in the prefix's
+    directory are grouped under the prefix itself.'''
+    groups = defaultdict(list)
+    for url in urls:
+        rest = canonical(url)[len(prefix):]
+        groups[prefix + rest[:rest.index('/') + 1] if '/' in rest else prefix].append(url)
+    return groups
+
+
+def common_prefix(urls: list) -> str:
+    '''Returns the longest host/directory prefix (protocol-less, ending in /) shared by URLs on the same host.'''
+    keys = [canonical(url) for url in urls]
+    prefix = posixpath.commonprefix(keys)
+    return prefix[:prefix.rfind('/') + 1] if '/' in prefix else prefix.split('?')[0] + '/'
+
+
+def check_urls(urls, cdx_root: str = settings.qa_cdx_root, bulk_threshold: int = settings.cdx_bulk_threshold,
+               cache=None, logger=default_logger) -> dict:
+    '''Checks the presence of many URLs in a CDX index. Returns a dict of url: True/False.
+    If a CDXCache is given, unexpired cached answers are used and new answers are stored.
+    URLs are grouped by host. Hosts with at least bulk_threshold candidates are fetched with one (paginated)
+    prefix query on their common directory and the candidates are answered locally. If the directory holds too
+    many captures for its candidates (see prefix_captured) they are split by the directories below it, the same rule
+    applying to each.
+    The rest (and those of a failed prefix query) are checked one by one (in threads, within the rate limit).
+    URLs whose check fails are logged and left out of the result, so one failure does not lose the others.'''
+    urls = set(urls)
+    cached = cache.get_many(urls, cdx_root) if cache else {}
+    if cache:
+        logger.info(f'CDX cache: {len(cached)} of {len(urls)} URLs answered.')
+
+    groups = defaultdict(list)
+    for url in urls - set(cached):
+        groups[(urlsplit(url if '://' in url else f'http://{url}').hostname or '').lower()].append(url)
+
+    results = {}
+    single = []
+    pending = list(groups.values())
+    while pending:
+        group = pending.pop()
+        if len(group) < bulk_threshold:
+            single += group
+            continue
+        prefix = common_prefix(group)
+        logger.info(f'Checking {len(group)} URLs with a prefix query on {prefix}')
+        try:
+            captured = prefix_captured(group, prefix, cdx_root, logger)
+        except Exception as e:
+            logger.error(f'Prefix query on {prefix} failed ({e!r}). Checking its {len(group)} URLs individually.')
+            single += group
+            continue
+        if captured is None:
+            subgroups = split_by_directory(group, prefix)
+            logger.info(f'{prefix} has too many captures for {len(group)} URLs. Splitting into {len(subgroups)} directories.')
+            single += subgroups.pop(prefix, [])        # URLs directly in the directory cannot be narrowed down further
+            pending += subgroups.values()
+            continue
+        results.update((url, canonical(url) in captured) for url in group)
+
+    def check(url: str):
+        try:
+            return url_in_cdx_index(url, cdx_root, logger)
+        except Exception as e:
+            logger.error(f'CDX check of {url} failed. {e!r}')
+            return None
+
+    logger.info(f'Checking {len(single)} URLs individually.')
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        answers = dict(zip(single, executor.map(check, single)))
+    failed = [url for url, present in answers.items() if present is None]
+    if failed:
+        logger.warning(f'{len(failed)} of {len(single)} individual CDX checks failed. Their URLs are left unanswered.')
+    results.update((url, present) for url, present in answers.items() if present is not None)
+
+    if cache:
+        cache.put_many(results, cdx_root)
+    return {**cached, **results}
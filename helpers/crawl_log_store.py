@@ -0,0 +1,89 @@
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Heritrix crawl.log fields, in order. Annotations (the last field) are not stored.
+schema = pa.schema([
+    ('timestamp', pa.string()),
+    ('status', pa.int32()),
+    ('size', pa.int64()),
+    ('url', pa.string()),
+    ('discovery_path', pa.string()),
+    ('via', pa.string()),
+    ('mime', pa.string()),
+    ('digest', pa.string()),
+])
+fields = {'timestamp': 0, 'status': 1, 'size': 2, 'url': 3, 'discovery_path': 4, 'via': 5, 'mime': 6, 'digest': 9}
+fingerprint_key = b'aqa.fingerprint'
+
+
+def to_int(value: str):
+    try:
+        return int(value)
+    except ValueError:      # '-' for unknown sizes
+        return None
+
+
+def parse_lines(lines, batch_size: int = 500000):
+    '''Parses crawl log lines into pyarrow RecordBatches of at most batch_size rows.
+    Malformed lines (fewer than 10 fields) are skipped.'''
+    columns = {name: [] for name in fields}
+    rows = 0
+    for line in lines:
+        parts = line.split(None, 11)
+        if len(parts) < 10:
+            continue
+        for name, index in fields.items():
+            columns[name].append(parts[index])
+        rows += 1
+        if rows == batch_size:
+            yield to_batch(columns)
+            columns = {name: [] for name in fields}
+            rows = 0
+    if rows:
+        yield to_batch(columns)
+
+
+def to_batch(columns: dict) -> pa.RecordBatch:
+    columns['status'] = [to_int(x) for x in columns['status']]
+    columns['size'] = [to_int(x) for x in columns['size']]
+    columns['via'] = [None if x == '-' else x for x in columns['via']]
+    columns['digest'] = [None if x == '-' else x for x in columns['digest']]
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+def fingerprint(path: str):
+    '''Returns the fingerprint a store was built with, or None if there is no (readable) store.'''
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return None
+    return metadata.get(fingerprint_key, b'').decode() or None
+
+
+def build(lines, path: str, fingerprint: str = '') -> int:
+    '''Parses crawl log lines once into a Parquet file at path. The fingerprint (e.g. a hash of the source logs' ETags)
+    is saved in the file metadata so callers can tell whether the store is up to date.
+    The file is written atomically. Returns the number of rows written.'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    rows = 0
+    try:
+        with pq.ParquetWriter(tmp_path, schema.with_metadata({fingerprint_key: fingerprint.encode()})) as writer:
+            for batch in parse_lines(lines):
+                writer.write_batch(batch)
+                rows += batch.num_rows
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return rows
+
+
+def read(path: str, columns: list = None, filters: list = None):
+    '''Reads (memory-mapped) columns of a crawl log store into a DataFrame.
+    filters are pyarrow/pandas predicate tuples e.g. [('status', '>=', 200), ('status', '<', 400)]'''
+    return pq.read_table(path, columns=columns, filters=filters, memory_map=True).to_pandas()
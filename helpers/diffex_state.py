@@ -0,0 +1,42 @@
+import os
+import json
+import time
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import settings
+
+metadata_key = b'aqa.diffex'
+columns = ['clean_url', 'URL Encoded Address', 'in_crawl', 'in_qa']
+
+
+def load(path: str, max_age: int = settings.diffex_state_max_age):
+    '''Returns the previous diffex run's rows and metadata from path as (DataFrame, dict).
+    Returns (None, {}) if there is no (readable) state or it is older than max_age seconds.
+    in_crawl and in_qa are nullable booleans: NA where they were not determined.'''
+    try:
+        table = pq.read_table(path)
+        metadata = json.loads((table.schema.metadata or {})[metadata_key])
+    except (FileNotFoundError, KeyError, ValueError, pa.ArrowInvalid):
+        return None, {}
+    if time.time() - metadata.get('saved_at', 0) > max_age:
+        return None, {}
+    return table.to_pandas().astype({'in_crawl': 'boolean', 'in_qa': 'boolean'}), metadata
+
+
+def save(path: str, df: pd.core.frame.DataFrame, **metadata):
+    '''Saves a diffex run's rows (see columns) and metadata (e.g. the crawl log fingerprint) to path, atomically.'''
+    metadata['saved_at'] = time.time()
+    table = pa.Table.from_pandas(df[columns], preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), metadata_key: json.dumps(metadata).encode()})
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
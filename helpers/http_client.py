@@ -0,0 +1,163 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import settings
+from helpers import pausing
+from objects.RateLimiter import RateLimiter
+
+logger = logging.getLogger('__main__.http')
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+
+class CircuitOpen(Exception):
+    '''Raised without making a request while an endpoint's circuit breaker is open.'''
+    pass
+
+
+class CircuitBreaker:
+    '''Stops requests to an endpoint after settings.circuit_failures consecutive failures.
+    After settings.circuit_reset_seconds one trial request is let through: success closes the circuit,
+    failure opens it again.'''
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= settings.circuit_reset_seconds:
+                self.opened_at = time.time()        # half open: one trial, others wait for the next reset period
+                return True
+            return False
+
+    def record(self, success: bool):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= settings.circuit_failures:
+                    self.opened_at = time.time()
+
+
+class EndpointStats:
+    '''Request, error and latency counters for an endpoint.'''
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, latency: float, error: bool):
+        with self.lock:
+            self.requests += 1
+            self.errors += error
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def __str__(self):
+        mean = self.latency / self.requests if self.requests else 0
+        return f'{self.requests} request(s), {self.errors} error(s), {mean:.2f}s mean / {self.max_latency:.2f}s max latency'
+
+
+breakers = defaultdict(CircuitBreaker)
+endpoint_stats = defaultdict(EndpointStats)
+
+
+def session() -> requests.Session:
+    '''Returns the process's shared Session, which keeps connections alive in per-host pools.
+    A new one is created in forked children.'''
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=settings.http_pool_hosts, pool_maxsize=settings.http_pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+def backoff(attempt: int) -> float:
+    '''Exponential backoff with full jitter.'''
+    return random.uniform(0, min(settings.http_backoff_max, settings.http_backoff_base * 2 ** attempt))
+
+
+def request(method: str, url: str, endpoint: str, retries: int = settings.http_retries, per_host: bool = False,
+            **kwargs) -> requests.Response:
+    '''Makes a request through the shared session.
+    endpoint names the service for the circuit breaker, counters and (if it is in settings.rate_limits)
+    the shared RateLimiter. Connection errors, timeouts, 429s and 5xx responses are retried with jittered
+    exponential backoff up to retries times. The last response is returned if retries run out on an HTTP error,
+    the last exception is raised if they run out on a connection error.
+    Raises CircuitOpen if the endpoint has been failing. per_host gives each host its own circuit breaker
+    (e.g. for live sites, where one site being down says nothing about the others).'''
+    kwargs.setdefault('timeout', settings.http_timeout)
+    kwargs.setdefault('headers', settings.default_headers)
+    limiter = RateLimiter.get(endpoint) if endpoint in settings.rate_limits else None
+    breaker = breakers[f'{endpoint}:{urlsplit(url).hostname}' if per_host else endpoint]
+
+    for attempt in range(retries + 1):
+        pausing.checkpoint()
+        if not breaker.allow():
+            raise CircuitOpen(f'{endpoint} circuit open after repeated failures. Not requesting {url}')
+        limiter.acquire() if limiter else None
+        start = time.time()
+        try:
+            response = session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            endpoint_stats[endpoint].record(time.time() - start, error=True)
+            breaker.record(success=False)
+            if attempt == retries:
+                raise
+            logger.debug(f'{endpoint}: {method} {url} failed ({e!r}). Retrying.')
+        else:
+            failed = response.status_code == 429 or response.status_code >= 500
+            endpoint_stats[endpoint].record(time.time() - start, error=failed)
+            limiter.report(response.status_code) if limiter else None
+            breaker.record(success=not failed)
+            if not failed or attempt == retries:
+                return response
+            logger.debug(f'{endpoint}: {method} {url} [{response.status_code}]. Retrying.')
+            response.close()
+        time.sleep(backoff(attempt))
+
+
+def get(url: str, endpoint: str, **kwargs) -> requests.Response:
+    return request('GET', url, endpoint, **kwargs)
+
+
+def download(url: str, endpoint: str, path: str, chunk_size: int = 1024 ** 2, **kwargs) -> int:
+    '''Streams a GET response body to a file without holding it in memory. The file is only put in place once
+    complete. Returns the number of bytes written. Raises an exception if the response is not 200.'''
+    with request('GET', url, endpoint, stream=True, **kwargs) as response:
+        if response.status_code != 200:
+            raise Exception(f'{endpoint}: GET {url} failed [{response.status_code}] {response.text[:500]}')
+        written = 0
+        with open(f'{path}.part', 'wb') as dest:
+            for chunk in response.iter_content(chunk_size):
+                written += dest.write(chunk)
+    os.replace(f'{path}.part', path)
+    return written
+
+
+def stats() -> str:
+    '''Returns the process's per-endpoint counters.'''
+    return '\n'.join(f'{endpoint}: {counters}' for endpoint, counters in sorted(endpoint_stats.items()))
@@ -0,0 +1,74 @@
+import os
+import logging
+
+import boto3
+
+import settings
+from env import secrets
+from helpers import s3, crawl_log_store
+from helpers.select_processes import guid_regex
+
+default_logger = logging.getLogger('__main__.job_cost')
+_s3client = None
+
+
+def s3client():
+    global _s3client
+    if _s3client is None:
+        _s3client = boto3.Session(aws_access_key_id=secrets.S3ACCESS_KEY,
+                                  aws_secret_access_key=secrets.S3SECRET_KEY).client('s3')
+    return _s3client
+
+
+def pdf_count(crawl_id: str):
+    '''Returns the number of PDFs in a crawl's local crawl log store (from an earlier run), or None if there is none.'''
+    path = os.path.join(settings.aqa_dir, str(crawl_id), 'crawl-log.parquet')
+    if not crawl_log_store.fingerprint(path):
+        return None
+    mime = crawl_log_store.read(path, ['mime'], [('status', '>=', 200), ('status', '<', 400)]).mime
+    return int(mime.str.startswith('application/pdf', na=False).sum())
+
+
+def signals(issue, processes: list, logger=default_logger) -> dict:
+    '''Collects cheap signals of how much work a queued crawl is: crawl.log bytes (from the S3 listing),
+    the PDF count (if the crawl log has been parsed before), the diffex.csv size (from the Jira attachment)
+    and the selected sub-processes. Signals which cannot be collected are None.'''
+    found = {'processes': processes, 'crawl_log_bytes': None, 'pdf_count': None, 'diffex_bytes': None}
+    try:
+        logs = s3.list_objects(s3client(), secrets.data_bucket, f'crawl-logs/tna-{issue.crawl_id}')
+        found['crawl_log_bytes'] = sum(x['Size'] for x in logs if '/crawl.log' in x['Key'])
+    except Exception:
+        logger.exception(f'{issue.crawl_id}\tCould not list crawl logs for a cost estimate.')
+    try:
+        found['pdf_count'] = pdf_count(issue.crawl_id)
+    except Exception:
+        logger.exception(f'{issue.crawl_id}\tCould not count PDFs for a cost estimate.')
+    diffex_sizes = [file.get('size', 0) for file in issue.data['attachment']
+                    if guid_regex.sub('', file['filename']).lower() == settings.diffex_filename]
+    found['diffex_bytes'] = max(diffex_sizes) if diffex_sizes else None
+    return found
+
+
+def estimate(signals: dict, model: dict = settings.job_cost_model) -> float:
+    '''Estimates a job's runtime in seconds from its signals with a linear model per sub-process
+    (see settings.job_cost_model). Missing signals fall back to the model's defaults.'''
+    gb = (signals['crawl_log_bytes'] if signals['crawl_log_bytes'] is not None else model['default_crawl_log_bytes']) / 1024 ** 3
+    pdfs = signals['pdf_count'] if signals['pdf_count'] is not None else gb * model['pdfs_per_crawl_log_gb']
+    diffex_gb = (signals['diffex_bytes'] or 0) / 1024 ** 3
+    seconds = model['base']
+    for process in signals['processes']:
+        coefficients = model.get(process, {})
+        seconds += coefficients.get('base', 0) + coefficients.get('per_crawl_log_gb', 0) * gb + \
+            coefficients.get('per_pdf', 0) * pdfs + coefficients.get('per_diffex_gb', 0) * diffex_gb
+    return seconds
+
+
+def footprint(signals: dict, model: dict = settings.job_memory_model) -> float:
+    '''Estimates a job's peak memory in bytes, over an idle worker's, from its signals with a linear model per
+    sub-process (see settings.job_memory_model). Sub-processes may run concurrently so their footprints are added.'''
+    log_bytes = signals['crawl_log_bytes'] if signals['crawl_log_bytes'] is not None else model['default_crawl_log_bytes']
+    footprint_bytes = model['base']
+    for process in signals['processes']:
+        coefficients = model.get(process, {})
+        footprint_bytes += coefficients.get('base', 0) + coefficients.get('per_crawl_log_byte', 0) * log_bytes
+    return footprint_bytes
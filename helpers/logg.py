@@ -48,4 +48,15 @@ def create_StreamHandler(output, level, format='%(asctime)s\t%(name)s\t%(message
     formatter = logging.Formatter(format)
     handler.setFormatter(formatter)
 
-    return handler
\ No newline at end of file
+    return handler
+
+
+def close_handlers(logger_name: str):
+    '''Closes and removes the handlers of a logger and its descendants (e.g. a crawl's loggers once a
+    long-lived worker has finished with it), so they do not pile up or keep files open.'''
+    names = [name for name in logging.Logger.manager.loggerDict if name == logger_name or name.startswith(f'{logger_name}.')]
+    for name in names:
+        logger = logging.getLogger(name)
+        for handler in logger.handlers.copy():
+            logger.removeHandler(handler)
+            handler.close()
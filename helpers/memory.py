@@ -0,0 +1,60 @@
+import os
+
+page_size = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss(pid='self') -> int:
+    '''Returns a process's resident set size in bytes (from /proc/<pid>/statm), or 0 if it has gone.'''
+    try:
+        with open(f'/proc/{pid}/statm') as source:
+            return int(source.read().split()[1]) * page_size
+    except (FileNotFoundError, ProcessLookupError, IndexError):
+        return 0
+
+
+def descendants(pid: int) -> list:
+    '''Returns the PIDs of a process's children, their children and so on (from the parent PIDs in /proc/<pid>/stat).'''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as source:
+                stat = source.read()
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        parent = int(stat[stat.rindex(')') + 2:].split()[1])      # the command name may contain spaces or brackets
+        children.setdefault(parent, []).append(int(entry))
+    found = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+def tree_rss(pid: int) -> int:
+    '''Returns the resident set size in bytes of a process and its descendants (e.g. PDFflash's pool).
+    Pages shared between them (e.g. after a fork) are counted once per process, so this errs high.'''
+    return rss(pid) + sum(rss(child) for child in descendants(pid))
+
+
+def meminfo() -> dict:
+    '''Returns /proc/meminfo as a dict of name: bytes.'''
+    info = {}
+    with open('/proc/meminfo') as source:
+        for line in source:
+            name, value = line.split(':', 1)
+            value = value.split()
+            info[name] = int(value[0]) * (1024 if value[1:] == ['kB'] else 1)
+    return info
+
+
+def available() -> int:
+    '''Returns the memory in bytes the kernel estimates is available for new work without swapping (MemAvailable).'''
+    return meminfo()['MemAvailable']
+
+
+def total() -> int:
+    return meminfo()['MemTotal']
@@ -0,0 +1,27 @@
+'''Cooperative pausing of worker processes (see objects/Worker.py).
+A paused worker stops at its next checkpoint rather than wherever a signal would land, so it never stops while
+holding a lock other workers need (a rate limit flock, a cache's SQLite write lock). Checkpoints are placed
+between units of work: before each rate limited or HTTP request, between PDFs and between diffex chunks.
+Child processes of a worker (e.g. the PDF pool) are started from context, not forked from the worker's threads,
+and are handed its event (see install) so they pause with it.'''
+
+import multiprocessing
+
+context = multiprocessing.get_context('forkserver')    # events from it can be passed to forkserver children
+resume_event = None     # set while the worker may run; None outside workers
+
+
+def install(event):
+    '''Makes this process pause at checkpoints while event (from context.Event()) is clear.'''
+    global resume_event
+    resume_event = event
+
+
+def paused() -> bool:
+    return resume_event is not None and not resume_event.is_set()
+
+
+def checkpoint():
+    '''Blocks while the process handler has paused this worker. Only call where no shared lock is held.'''
+    if resume_event is not None:
+        resume_event.wait()
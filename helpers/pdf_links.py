@@ -0,0 +1,232 @@
+import re
+import time
+import queue
+import signal
+import resource
+import tempfile
+from functools import partial
+
+import boto3
+import PyPDF2
+
+import settings
+from helpers import warc, http_client, pausing
+
+url_regex = re.compile('^https?://\S+')
+s3client = None         # set in each pool worker by init_worker when reading PDFs from WARCs
+
+
+class PDFTimeout(Exception):
+    pass
+
+
+class PDFRejected(Exception):
+    pass
+
+
+def get_key(object, key, otherwise=None):
+    '''x.get(a) not performing like x[a] with PyPDF2 dictionaries so naming a
+    function which replicates that behaviour'''
+    try:
+        return object[key]
+    except:
+        return otherwise
+
+
+def get_urls_from_page(pageObject) -> list:
+    '''Harvests URLs from a PDF page. taking a PyPDF2 page object.'''
+    annots_tag, uri_tag, ank_tag = '/Annots', '/URI', '/A'
+    text = pageObject.extractText()
+    urls = url_regex.findall(text)
+
+    annots = get_key(pageObject, annots_tag, [])
+    for annot in annots:
+        try:
+            annot = annot.getObject()
+            anks = get_key(annot, ank_tag, dict())
+            url = get_key(anks, uri_tag, otherwise='')
+            urls.append(url) if url_regex.match(url) else None
+        except Exception:
+            continue
+    return urls
+
+
+def extract_urls(pdf_file) -> list:
+    '''Harvests URLs from a PDF file object'''
+    pdfReader = PyPDF2.PdfFileReader(pdf_file)
+    urls = []
+    for page in range(pdfReader.numPages):
+        urls += get_urls_from_page(pdfReader.getPage(page))
+    return urls
+
+
+def is_pdf_type(content_type: str) -> bool:
+    '''PDFs are sometimes served as generic binary so application/octet-stream is also accepted.'''
+    content_type = content_type.split(';')[0].strip().lower()
+    return not content_type or 'pdf' in content_type or content_type == 'application/octet-stream'
+
+
+def fetch_pdf(url: str, max_bytes: int = settings.pdf_max_bytes, spool_bytes: int = settings.pdf_spool_bytes):
+    '''Streams a PDF into a temporary file which is held in memory up to spool_bytes and spills to disk above that.
+    Returns the file object (positioned at the start).
+    Raises PDFRejected without reading the body if the Content-Type is not a PDF or the Content-Length is
+    over max_bytes, and stops reading if the body grows past max_bytes.'''
+    with http_client.get(url, 'live', per_host=True, retries=1, timeout=settings.pdf_timeout, stream=True) as r:
+        r.raise_for_status()
+        content_type = r.headers.get('Content-Type', '')
+        if not is_pdf_type(content_type):
+            raise PDFRejected(f'Not a PDF ({content_type})')
+        if int(r.headers.get('Content-Length') or 0) > max_bytes:
+            raise PDFRejected(f'Larger than {max_bytes} bytes ({r.headers["Content-Length"]})')
+
+        pdf_file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        try:
+            size = 0
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PDFRejected(f'Larger than {max_bytes} bytes')
+                pdf_file.write(chunk)
+        except BaseException:           # includes PDFTimeout, so no spilled file is left open
+            pdf_file.close()
+            raise
+    pdf_file.seek(0)
+    return pdf_file
+
+
+def get_urls_from_pdf(url: str) -> list:
+    '''Harvests URLs from a PDF at a given url'''
+    with fetch_pdf(url) as pdf_file:
+        return extract_urls(pdf_file)
+
+
+def get_urls_from_warc(bucket: str, location: tuple, max_bytes: int = settings.pdf_max_bytes) -> list:
+    '''Harvests URLs from a PDF captured in a WARC. location is (warc key, offset, length)'''
+    if location[2] > max_bytes:
+        raise PDFRejected(f'Larger than {max_bytes} bytes ({location[2]})')
+    try:
+        pdf_file = warc.fetch_payload(s3client, bucket, location, max_bytes=max_bytes)
+    except warc.PayloadTooLarge as e:
+        raise PDFRejected(str(e))
+    with pdf_file:
+        return extract_urls(pdf_file)
+
+
+def vm_size() -> int:
+    '''Returns the virtual memory size of the current process in bytes (from /proc).'''
+    with open('/proc/self/status') as source:
+        for line in source:
+            if line.startswith('VmSize:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def raise_timeout(signum, frame):
+    raise PDFTimeout()
+
+
+def init_worker(memory_limit: int, aws_credentials: dict = None, resume_event=None):
+    '''Pool initializer. Caps the worker's address space at its current size plus memory_limit bytes
+    (so a pathological PDF raises MemoryError instead of exhausting the machine)
+    and installs the alarm handler used for per-PDF timeouts.
+    If aws_credentials (boto3.Session keyword arguments) are given, the worker gets its own S3 client for reading WARCs.
+    The worker pauses with the process which started the pool while resume_event is clear (see helpers/pausing.py).'''
+    global s3client
+    pausing.install(resume_event)
+    if aws_credentials:
+        s3client = boto3.Session(**aws_credentials).client('s3')
+    if memory_limit:
+        limit = vm_size() + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    signal.signal(signal.SIGALRM, raise_timeout)
+
+
+def worker(task: tuple, timeout: int, bucket: str = None) -> tuple:
+    '''Reads and parses one PDF inside a pool worker, within timeout seconds.
+    task is (url, location): the PDF is read from its WARC record if location is given,
+    falling back to the live URL if that fails.
+    Returns (url, urls, error) where error is None on success.'''
+    url, location = task
+    pausing.checkpoint()        # before the timer starts, so time paused does not count against the PDF
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        if location and s3client:
+            try:
+                return url, get_urls_from_warc(bucket, location), None
+            except (PDFTimeout, MemoryError, PDFRejected):     # the live copy would be no different
+                raise
+            except Exception:
+                pass
+        return url, get_urls_from_pdf(url), None
+    except PDFTimeout:
+        return url, [], f'Timed out after {timeout}s'
+    except MemoryError:
+        return url, [], 'Exceeded memory limit'
+    except Exception as e:
+        return url, [], repr(e)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def extract_all(pdfs, locations: dict = None, aws_session=None, bucket: str = None,
+                processes: int = settings.pdf_workers, timeout: int = settings.pdf_timeout,
+                memory_limit: int = settings.pdf_worker_memory_bytes, logger=None):
+    '''Downloads and parses PDFs concurrently on a bounded process pool, yielding (url, urls, error)
+    as each PDF finishes (in completion order).
+    locations is an optional dict of url: (warc key, offset, length) (see Crawl.warc_index); PDFs found in it are
+    read from the crawl's WARCs in the S3 bucket with the aws_session, the rest are downloaded from the live web.
+    Workers are started by a forkserver (forking the calling process, which may hold locks in other threads, could
+    deadlock them), so they are handed frozen credentials rather than the session itself.
+    Workers are recycled every settings.pdf_max_tasks_per_worker PDFs. Only as many PDFs as there are workers are
+    submitted at once, each with its own deadline of twice the timeout (time the worker is paused does not count).
+    If a worker dies outright (so its result never arrives) its PDF is yielded with an error once the deadline
+    passes and the rest carry on.'''
+    locations = locations or {}
+    tasks = iter([(pdf, locations.get(pdf)) for pdf in pdfs])
+    finished = queue.Queue()
+    deadlines = {}      # url: time by which its result is expected
+
+    def submit():
+        for url, location in tasks:
+            pool.apply_async(run, ((url, location),), callback=finished.put,
+                             error_callback=lambda e, url=url: finished.put((url, [], repr(e))))
+            deadlines[url] = time.time() + timeout * 2
+            return
+
+    def wait_if_paused():
+        '''Waits while the worker is paused, moving the deadlines on by the time paused.'''
+        start = time.time()
+        pausing.checkpoint()
+        for url in deadlines:
+            deadlines[url] += time.time() - start
+
+    aws_credentials = None
+    if aws_session:
+        credentials = aws_session.get_credentials().get_frozen_credentials()
+        aws_credentials = {'aws_access_key_id': credentials.access_key, 'aws_secret_access_key': credentials.secret_key,
+                           'aws_session_token': credentials.token, 'region_name': aws_session.region_name}
+
+    with pausing.context.Pool(processes, initializer=init_worker,
+                              initargs=(memory_limit, aws_credentials, pausing.resume_event),
+                              maxtasksperchild=settings.pdf_max_tasks_per_worker) as pool:
+        run = partial(worker, timeout=timeout, bucket=bucket)
+        for _ in range(processes):
+            submit()
+        while deadlines:
+            try:
+                url, urls, error = finished.get(timeout=max(0, min(min(deadlines.values()) - time.time(), 1)))
+            except queue.Empty:
+                wait_if_paused()
+                now = time.time()
+                for url in [url for url, deadline in deadlines.items() if deadline <= now]:
+                    del deadlines[url]
+                    submit()
+                    logger.error(f'No result for {url} within {timeout * 2}s, its worker may have died.') if logger else None
+                    yield url, [], f'No result within {timeout * 2}s (worker died?)'
+                continue
+            if url not in deadlines:        # already reported as timed out
+                continue
+            del deadlines[url]
+            submit()
+            wait_if_paused()
+            yield url, urls, error
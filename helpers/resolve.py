@@ -0,0 +1,82 @@
+import queue
+import asyncio
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import settings
+from objects.RateLimiter import RateLimiter
+
+done = object()     # end of results marker
+
+
+async def resolve_url(session, url: str, global_limit: asyncio.Semaphore, host_limits: dict) -> tuple:
+    '''Follows a URL's redirects with a HEAD request, falling back to GET if the server refuses or fails HEAD
+    (an error status or a failed request). Bodies are never read. Returns (url, status, final url, error).
+    The host's slot is taken before a global one, so URLs queued behind a busy host do not hold global slots.'''
+    host = urlsplit(url).hostname or ''
+    limiter = RateLimiter.get('live')
+    async with host_limits[host], global_limit:
+        try:
+            await limiter.acquire_async()
+            async with session.head(url, allow_redirects=True) as r:
+                limiter.report(r.status)
+                if r.status < 400:
+                    return url, r.status, str(r.url), None
+        except Exception:
+            pass        # e.g. the connection is reset on HEAD: tried again with GET
+        try:
+            await limiter.acquire_async()
+            async with session.get(url, allow_redirects=True) as r:      # released without reading the body
+                limiter.report(r.status)
+                return url, r.status, str(r.url), None
+        except Exception as e:
+            return url, None, url, repr(e)
+
+
+async def resolve_urls(urls, results: queue.Queue, concurrency: int, per_host: int, timeout: int):
+    global_limit = asyncio.Semaphore(concurrency)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(per_host))
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    async with aiohttp.ClientSession(connector=connector, headers=settings.default_headers,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        # Tasks are created in batches so millions of URLs don't each hold a pending task
+        urls = iter(urls)
+        pending = set()
+        while True:
+            for url in urls:
+                pending.add(asyncio.ensure_future(resolve_url(session, url, global_limit, host_limits)))
+                if len(pending) >= concurrency * 4:
+                    break
+            if not pending:
+                break
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                results.put(task.result())
+
+
+def resolve_all(urls, concurrency: int = settings.resolve_concurrency, per_host: int = settings.resolve_per_host,
+                timeout: int = settings.resolve_timeout):
+    '''Resolves redirects for many URLs concurrently (capped globally and per host) on an asyncio event loop in a
+    background thread. Yields (url, status, final url, error) as each URL resolves, so callers can process results
+    as a pipeline. status is None (and error set) if the request failed.'''
+    results = queue.Queue(maxsize=concurrency * 4)
+    errors = []
+
+    def run():
+        try:
+            asyncio.run(resolve_urls(urls, results, concurrency, per_host, timeout))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            results.put(done)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while (result := results.get()) is not done:
+        yield result
+    thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,125 @@
+import zlib
+import concurrent.futures
+
+import settings
+
+gzip_magic = b'\x1f\x8b'
+
+
+def iter_chunks(s3client, bucket: str, key: str, chunk_size: int = 1024 * 1024):
+    '''Streams an S3 object in chunks of chunk_size bytes without reading the whole body into memory.'''
+    body = s3client.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+
+def gunzip_chunks(chunks):
+    '''Takes an iterable of byte chunks and yields them decompressed if they are gzipped (detected by the gzip
+    magic number), otherwise they are passed through unchanged. Handles multi-member gzip files
+    (e.g. concatenated gzipped crawl.log parts).'''
+    chunks = iter(chunks)
+    first = next(chunks, b'')
+    if not first.startswith(gzip_magic):
+        yield first
+        yield from chunks
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = first
+    while True:
+        while data:
+            yield decompressor.decompress(data)
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = b''
+        data = next(chunks, None)
+        if data is None:
+            break
+    yield decompressor.flush()
+
+
+def iter_lines(chunks, encoding: str = 'utf-8'):
+    '''Takes an iterable of byte chunks and yields decoded lines (without line endings).
+    Only one partial line is held between chunks.'''
+    leftover = b''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        lines = (leftover + chunk).split(b'\n')
+        leftover = lines.pop()
+        for line in lines:
+            yield line.rstrip(b'\r').decode(encoding, errors='replace')
+    if leftover:
+        yield leftover.rstrip(b'\r').decode(encoding, errors='replace')
+
+
+def iter_cached_chunks(s3client, bucket: str, key: str, cache=None, etag: str = None, chunk_size: int = 1024 * 1024):
+    '''Streams an S3 object in chunks, reading through an S3Cache if one is given.
+    Cache misses are written to the cache as they are streamed.'''
+    if cache is None:
+        yield from iter_chunks(s3client, bucket, key, chunk_size)
+        return
+
+    etag = etag or s3client.head_object(Bucket=bucket, Key=key)['ETag']
+    path = cache.lookup(bucket, key, etag)
+    if path:
+        yield from cache.iter_chunks(path)
+    else:
+        yield from cache.put_chunks(bucket, key, etag, iter_chunks(s3client, bucket, key, chunk_size))
+
+
+def iter_object_lines(s3client, bucket: str, key: str, cache=None, etag: str = None, chunk_size: int = 1024 * 1024):
+    '''Streams the lines of a (optionally gzipped) text object in S3.'''
+    return iter_lines(gunzip_chunks(iter_cached_chunks(s3client, bucket, key, cache, etag, chunk_size)))
+
+
+def list_objects(s3client, bucket: str, prefix: str) -> list:
+    '''Lists every object under a prefix, following list_objects_v2 pagination.
+    Returns the combined 'Contents' entries.'''
+    paginator = s3client.get_paginator('list_objects_v2')
+    contents = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        contents += page.get('Contents', [])
+    return contents
+
+
+def get_object(s3client, bucket: str, key: str) -> bytes:
+    '''Downloads a whole S3 object and returns its bytes.'''
+    body = s3client.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        return body.read()
+    finally:
+        body.close()
+
+
+def read_object(s3client, bucket: str, key: str, cache=None, etag: str = None) -> bytes:
+    '''Returns the bytes of an S3 object, reading through an S3Cache if one is given.
+    If the ETag is not known (e.g. from a listing) it is fetched with a HEAD request.'''
+    if cache is None:
+        return get_object(s3client, bucket, key)
+
+    etag = etag or s3client.head_object(Bucket=bucket, Key=key)['ETag']
+    content = cache.get(bucket, key, etag)
+    if content is None:
+        response = s3client.get_object(Bucket=bucket, Key=key)
+        content = response['Body'].read()
+        cache.put(bucket, key, response['ETag'], content)     # the object may have changed since the listing
+    return content
+
+
+def fetch_many(s3client, bucket: str, keys: list, cache=None, etags: dict = None,
+               max_workers: int = settings.s3_max_workers) -> dict:
+    '''Downloads several S3 objects in parallel on a bounded thread pool sharing one (thread-safe) boto3 client.
+    Reads through an S3Cache if one is given; etags is an optional dict of key: ETag (e.g. from a listing).
+    Returns a dict of key: bytes in the order the keys were given.'''
+    if not keys:
+        return {}
+    etags = etags or {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        contents = executor.map(lambda key: read_object(s3client, bucket, key, cache, etags.get(key)), keys)
+        return dict(zip(keys, contents))
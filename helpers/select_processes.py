@@ -2,6 +2,11 @@ import gwa_jira
 import settings
 import re
 
+# JIRA adds ' (<guid>)' to the name of an attachment uploaded under an existing name. Removing it with this regex
+# matches e.g. a re-uploaded diffex.csv by its original name.
+guid_regex = re.compile(' \([0-9a-f]{8}-[0-9a-f]{4}-[1-5][0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}\)')
+
+
 def processes_to_run(issue: gwa_jira.Issue) -> list:
     '''Takes a gwa_jira Issue object (https://github.com/tna-webarchive/ukgwa-tools/blob/main/src/gwa_jira/Issue.py)
     and checks which autoQA sub processes need to be run. The sub-processes correspond to modules in the processes directory.'''
@@ -14,7 +19,6 @@ def processes_to_run(issue: gwa_jira.Issue) -> list:
         if issue.data['status']['name'] in ['Ready For QA', 'Partner QA']:
             processes.append('CLA')
 
-    guid_regex = re.compile(' \([0-9a-f]{8}-[0-9a-f]{4}-[1-5][0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}\)')
     ### GET DIFFEX FILE (if two diffex.csv have been uploaded, one will include a guid. if the original is deleted the regex ensures the new one is picked up.
     attachments = [guid_regex.sub('', file['filename']).lower() for file in issue.data['attachment']]
 
@@ -0,0 +1,72 @@
+import re
+from functools import lru_cache
+from urllib.parse import unquote, quote
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import settings
+
+url_clean_regex = re.compile('^(?:.?https?:\/\/)?(?:www\.)?(.*?)/?$')
+protocol_pattern = '^(?:.?https?:\/\/)?(?:www\d*\.)?'
+canonical_regex = re.compile(protocol_pattern + '(.*?)/?$', re.IGNORECASE)
+unsafe_regex = re.compile('[^A-Za-z0-9_.~/-]')        # characters quote(unquote(x)) may change
+
+
+@lru_cache(maxsize=settings.url_cache_size)
+def strip_protocol(url: str) -> str:
+    '''removes URL protocol (https://www.) and trailing slash if there'''
+    return url_clean_regex.sub(r'\1', url)
+
+
+@lru_cache(maxsize=settings.url_cache_size)
+def requote(url: str) -> str:
+    '''unquotes and quotes a url so differently encoded forms match'''
+    return quote(unquote(url))
+
+
+@lru_cache(maxsize=settings.url_cache_size)
+def canonical(url: str) -> str:
+    '''Canonical key for comparing URLs across the crawl log, Screaming Frog exports and CDX indexes.
+    Fragment, protocol, www. and trailing slash are removed, the URL is unquoted and quoted and the host lower-cased
+    e.g. HTTPS://WWW.Example.gov.uk/a%7Eb/#top -> example.gov.uk/a~b'''
+    url = canonical_regex.sub(r'\1', url.split('#')[0].strip())
+    if unsafe_regex.search(url):
+        url = requote(url)
+    host, slash, path = url.partition('/')
+    return host.lower() + slash + path
+
+
+def quote_ascii(keys: pa.Array) -> pa.Array:
+    '''Vectorized quote() for ASCII strings without escapes (%), where unquoting does nothing.
+    One Arrow replace per unsafe character actually present in the data.'''
+    data = keys.buffers()[2]
+    present = np.flatnonzero(np.bincount(np.frombuffer(data, np.uint8), minlength=128)) if data else []
+    for code in present:
+        char = chr(code)
+        if code < 128 and char != '%' and unsafe_regex.match(char):
+            keys = pc.replace_substring(keys, char, f'%{code:02X}')
+    return keys
+
+
+def canonical_series(urls: pd.Series) -> pd.Series:
+    '''Vectorized canonical() over a pandas Series of URLs, giving the same keys with the same index.
+    The regexes, quoting of plain ASCII URLs and lower-casing run in Arrow compute kernels.
+    Only URLs which are already escaped or not ASCII are requoted one by one (via the cached requote).'''
+    keys = pa.array(urls.astype(str), type=pa.string())
+    keys = pc.utf8_trim_whitespace(pc.replace_substring_regex(keys, '(?s)#.*', ''))
+    keys = pc.replace_substring_regex(keys, '(?i)' + protocol_pattern, '')
+    keys = pc.replace_substring_regex(keys, '/$', '')
+    unsafe = pc.match_substring_regex(keys, unsafe_regex.pattern)
+    if pc.any(unsafe).as_py():
+        plain = pc.and_(unsafe, pc.and_(pc.string_is_ascii(keys), pc.invert(pc.match_substring(keys, '%'))))
+        escaped = pc.and_(unsafe, pc.invert(plain))
+        keys = pc.replace_with_mask(keys, plain, quote_ascii(pc.filter(keys, plain)))
+        keys = pc.replace_with_mask(keys, escaped, pa.array(map(requote, pc.filter(keys, escaped).to_pylist()), pa.string()))
+    host = pc.utf8_lower(pc.replace_substring_regex(keys, '(?s)/.*', ''))
+    path = pc.replace_substring_regex(keys, '^[^/]*', '')
+    canonical_keys = pc.binary_join_element_wise(host, path, '').to_pandas()
+    canonical_keys.index = urls.index
+    return canonical_keys
@@ -0,0 +1,186 @@
+import io
+import os
+import json
+import zlib
+import tempfile
+import itertools
+
+import settings
+
+record_allowance = 1024 ** 2     # bytes a record may exceed its body's limit by (WARC and HTTP headers, chunk sizes)
+
+
+def parse_cdx_line(line: str):
+    '''Parses a CDX index line, either CDXJ (urlkey timestamp {json}) or the space separated
+    CDX 11 format (N b a m s k r M S V g).
+    Returns (url, status, mime, length, offset, filename) or None for headers and malformed lines.'''
+    if not line or line.startswith(' CDX'):
+        return None
+    try:
+        if line.rstrip().endswith('}'):
+            record = json.loads(line.split(' ', 2)[2])
+            return (record['url'], record.get('status', '-'), record.get('mime', '-'),
+                    int(record['length']), int(record['offset']), record['filename'])
+        fields = line.split()
+        if len(fields) < 11:
+            return None
+        return fields[2], fields[4], fields[3], int(fields[8]), int(fields[9]), fields[10]
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+def build_index(cdx_lines, warc_keys: list, mimes: tuple = None) -> dict:
+    '''Builds a dict of url: (warc key, offset, length) for the successful (2xx) captures in CDX lines,
+    only keeping those whose MIME type starts with one of mimes if given (e.g. ('application/pdf',)).
+    CDX filenames are matched to WARC keys by basename. Later captures of the same URL replace earlier ones.'''
+    keys = {os.path.basename(key): key for key in warc_keys}
+    mimes = tuple(mime.lower() for mime in mimes) if mimes else None
+    index = {}
+    for line in cdx_lines:
+        record = parse_cdx_line(line)
+        if not record:
+            continue
+        url, status, mime, length, offset, filename = record
+        if not status.startswith('2') or os.path.basename(filename) not in keys:
+            continue
+        if mimes and not mime.lower().startswith(mimes):
+            continue
+        index[url] = (keys[os.path.basename(filename)], offset, length)
+    return index
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+def iter_blocks(source, length: int = None, block_size: int = 1024 ** 2):
+    '''Yields the bytes of a file object in blocks, up to length bytes if given.'''
+    while length is None or length > 0:
+        block = source.read(block_size if length is None else min(block_size, length))
+        if not block:
+            return
+        if length is not None:
+            length -= len(block)
+        yield block
+
+
+def iter_dechunked(source, block_size: int = 1024 ** 2):
+    '''Yields the decoded bytes of an HTTP chunked transfer-encoded body (WARCs store responses as sent)
+    from a file object, in blocks.'''
+    while True:
+        line = source.readline(1024)
+        if not line.strip():
+            return
+        size = int(line.split(b';')[0].strip() or b'0', 16)
+        if size == 0:
+            return
+        yield from iter_blocks(source, size, block_size)
+        source.read(2)      # the chunk's trailing \r\n
+
+
+def write_blocks(blocks, dest, max_bytes: int = None) -> int:
+    '''Writes blocks of bytes to a file object, returning the bytes written. Raises PayloadTooLarge past max_bytes.'''
+    written = 0
+    for block in blocks:
+        written += dest.write(block)
+        if max_bytes and written > max_bytes:
+            raise PayloadTooLarge(f'Larger than {max_bytes} bytes')
+    return written
+
+
+def inflate(blocks, dest, max_bytes: int = None, wbits: int = 47, step: int = 1024 ** 2) -> int:
+    '''Decompresses blocks of gzip/zlib data (wbits 47: detect either header) into a file object at most step
+    bytes at a time, so a small input cannot expand in memory. Returns the bytes written.
+    Raises PayloadTooLarge past max_bytes.'''
+    def decompressed():
+        decompressor = zlib.decompressobj(wbits)
+        for data in blocks:
+            while data and not decompressor.eof:
+                yield decompressor.decompress(data, step)
+                data = decompressor.unconsumed_tail
+            if decompressor.eof:
+                return
+        yield decompressor.flush()
+    return write_blocks(decompressed(), dest, max_bytes)
+
+
+def read_record(s3client, bucket: str, key: str, offset: int, length: int, dest=None, max_bytes: int = None):
+    '''Reads a single WARC record with a ranged S3 read, decompressing it if the WARC is gzipped
+    (each record of a .warc.gz is its own gzip member). The record is streamed into the file object dest if given
+    (returning the bytes written), otherwise it is returned. Raises PayloadTooLarge if it is over max_bytes.'''
+    if dest is None:
+        record = io.BytesIO()
+        read_record(s3client, bucket, key, offset, length, record, max_bytes)
+        return record.getvalue()
+    body = s3client.get_object(Bucket=bucket, Key=key, Range=f'bytes={offset}-{offset + length - 1}')['Body']
+    try:
+        blocks = iter_blocks(body)
+        first = next(blocks, b'')
+        blocks = itertools.chain([first], blocks)
+        if first.startswith(b'\x1f\x8b'):
+            return inflate(blocks, dest, max_bytes, 16 + zlib.MAX_WBITS)
+        return write_blocks(blocks, dest, max_bytes)
+    finally:
+        body.close()
+
+
+def parse_headers(block: bytes) -> dict:
+    headers = {}
+    for line in block.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower().decode(errors='replace')] = value.strip().decode(errors='replace')
+    return headers
+
+
+def read_header_block(source) -> bytes:
+    '''Reads a header block (up to and excluding the blank line which ends it) from a file object.'''
+    lines = []
+    while (line := source.readline(64 * 1024)) not in (b'\r\n', b''):
+        lines.append(line)
+    return b''.join(lines)[:-2]
+
+
+def write_payload(source, dest, max_bytes: int = None) -> dict:
+    '''Writes the decoded HTTP body of a WARC response record, read from a file object positioned at its start, to the
+    file object dest, undoing chunked transfer-encoding and gzip/deflate content-encoding as it streams.
+    Returns the HTTP headers (a dict with lower-case names). Raises PayloadTooLarge if the body is over max_bytes.'''
+    warc_headers = read_header_block(source)
+    http_headers = read_header_block(source)
+    headers = parse_headers(http_headers)
+    content_length = parse_headers(warc_headers).get('content-length')
+    length = max(0, int(content_length) - len(http_headers) - 4) if content_length else None  # not the trailing \r\n\r\n
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        blocks = iter_dechunked(source)
+    else:
+        blocks = iter_blocks(source, length)
+    if headers.get('content-encoding', '').lower() in ('gzip', 'x-gzip', 'deflate'):
+        inflate(blocks, dest, max_bytes)
+    else:
+        write_blocks(blocks, dest, max_bytes)
+    return headers
+
+
+def record_payload(record: bytes) -> tuple:
+    '''Splits a WARC response record into its HTTP headers (a dict with lower-case names) and decoded body.'''
+    body = io.BytesIO()
+    headers = write_payload(io.BytesIO(record), body)
+    return headers, body.getvalue()
+
+
+def fetch_payload(s3client, bucket: str, location: tuple, spool_bytes: int = settings.pdf_spool_bytes,
+                  max_bytes: int = settings.pdf_max_bytes):
+    '''Reads the HTTP body of a captured URL from its WARC (location is (warc key, offset, length)),
+    returning it in a spooled temporary file positioned at the start. The record and body are streamed through
+    spooled files (held in memory up to spool_bytes, then on disk). Raises PayloadTooLarge if the body is over max_bytes.'''
+    key, offset, length = location
+    with tempfile.SpooledTemporaryFile(max_size=spool_bytes) as record:
+        read_record(s3client, bucket, key, offset, length, record, max_bytes + record_allowance if max_bytes else None)
+        record.seek(0)
+        payload = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        try:
+            write_payload(record, payload, max_bytes)
+        except BaseException:
+            payload.close()
+            raise
+    payload.seek(0)
+    return payload
@@ -2,12 +2,12 @@ import os
 import sys
 import time
 
-import pickle
-
 from requests.auth import HTTPBasicAuth
 import gwa_jira
 import settings
-from helpers import logg, select_processes
+from helpers import logg, select_processes, job_cost
+from objects.RateLimiter import RateLimiter
+from objects.JobQueue import JobQueue
 
 # Configure Logs
 log_folder = os.path.join(os.path.join(settings.aqa_dir, 'jira_listener'), 'logs/')
@@ -19,50 +19,52 @@ sys.stdout = open(os.path.join(log_folder, 'std.out'), 'a')
 sys.stderr = open(os.path.join(log_folder, 'err.log'), 'a')
 logger.info('Logger Configured.')
 
+job_queue = JobQueue()
+
 
 def queue_issue(issue: gwa_jira.Issue):
     '''Takes a gwa_jira.Issue object (https://github.com/tna-webarchive/ukgwa-tools/blob/main/src/gwa_jira/Issue.py)
-    and runs it through a few tests. If conditions are right, the Issue will be
-    added to the queue directory (i.e. the Issue objetc pickled and saved in the queue with the filename matching the crawl ID'''
+    and runs it through a few tests. If conditions are right, the crawl will be
+    added to the job queue (see objects/JobQueue.py) with the issue's update time and the sub-processes to run'''
 
     crawl_dir = os.path.join(settings.aqa_dir, issue.crawl_id)
-    queue_path = os.path.join(settings.aqa_queue, issue.crawl_id)
 
     # Is the Crawl ID numeric? Mainly filters out social links
     if not issue.crawl_id.isnumeric():
         logger.info(f'{issue.crawl_id} not numeric. Skipping')
         return None
 
-    # If the Ticket 'Done'? If so, remove the crawl directory and queue (if they exist).
+    # If the Ticket 'Done'? If so, remove the crawl directory and queued job (if they exist).
     # This helps to tidy the crawl directory (if in the middle of autoQA process, it might error without a crawl directory
     # This is desired if the status changes to Done.
     if issue.data['status']['name'] == 'Done':
         logger.info(f'{issue.crawl_id}\tStatus = Done. Removing directory {crawl_dir}')
-        os.system(f'rm -f {queue_path}')
+        job_queue.remove(issue.crawl_id)
         os.system(f'rm -rf {crawl_dir}')
         return None
 
     # Are there sub-proceses to run on the crawl? If not, remove the crawl from the queue if already there.
-    if not select_processes.processes_to_run(issue):
+    processes = select_processes.processes_to_run(issue)
+    if not processes:
         logger.info('No processes to run.')
-        os.system(f'rm -f {queue_path}')
+        job_queue.remove(issue.crawl_id)
         return None
 
     # Is the crawl already in the queue? If so and the issue has not been updated since, leave in the queue.
-    if os.path.exists(queue_path):
-        logger.info(f'{issue.crawl_id} in queue.')
-        with open(queue_path, 'rb') as source:
-            queued_issue = pickle.load(source)
-        if queued_issue.data['updated'] == issue.data['updated']:
-            logger.info(f'{issue.crawl_id}\tNo updates since joining queue')
-            return None
-        else:
-            logger.info(f'{issue.crawl_id}\tTicket updated. Updating queued crawl.')
-
-    # Crawls which make it here are added to the queue. (or updated if already in the queue)
-    with open(queue_path, 'wb') as dest:
-        pickle.dump(issue, dest, protocol=pickle.HIGHEST_PROTOCOL)
-        logger.info(f'{issue.crawl_id}\tAdded to queue')
+    job = job_queue.get(issue.crawl_id)
+    if job and job['state'] in ('queued', 'running', 'done') and job['updated'] == issue.data['updated']:
+        logger.info(f'{issue.crawl_id}\tNo updates since joining queue')
+        return None
+
+    # Crawls which make it here are added to the queue (or updated if already in the queue),
+    # with estimates of their runtime and memory footprint for scheduling.
+    signals = job_cost.signals(issue, processes, logger)
+    estimated_seconds = job_cost.estimate(signals)
+    estimated_bytes = job_cost.footprint(signals)
+    if job_queue.enqueue(issue.crawl_id, issue.data['updated'], processes, estimated_seconds=estimated_seconds,
+                         estimated_bytes=estimated_bytes, signals=signals):
+        logger.info(f'{issue.crawl_id}\tAdded to queue. Estimated runtime {estimated_seconds:.0f}s, '
+                    f'memory {estimated_bytes / 1024 ** 2:.0f} MB from {signals}')
 
 
 def get_updated_issues(since_mins: int, auth: HTTPBasicAuth) -> list:
@@ -74,6 +76,7 @@ def get_updated_issues(since_mins: int, auth: HTTPBasicAuth) -> list:
 
     JQL = f'project = UKGWAC AND updated >= -{since_mins}m ORDER BY updated ASC'
     logger.debug(f'Getting tickets updated within the last {since_mins} minute(s).\n{JQL}')
+    RateLimiter.get('jira').acquire()
     updated_issues = gwa_jira.get_all(JQL, auth=auth, return_objects=True)
     return updated_issues
 
@@ -1,7 +1,7 @@
 import os
 import time
-import pickle
 import multiprocessing
+import multiprocessing.connection
 from multiprocessing_logging import install_mp_handler
 import boto3
 
@@ -9,17 +9,32 @@ import autoQA
 from jira_listener import jira_listener
 import settings
 from env import secrets
-from helpers import logg
+from helpers import logg, memory
+from objects.DirectoryWatcher import DirectoryWatcher
+from objects.JobQueue import JobQueue
+from objects.Worker import Worker
 
 
 class ProcessHandler:
-        '''Process handler class monitors and maintains available workers to run the autoQA application'''
+        '''Process handler class monitors and maintains available workers to run the autoQA application.
+        Crawls are run by a pool of long-lived workers (objects/Worker.py) fed jobs from the queue.
+        Memory is the usual bottleneck, so a crawl is only claimed if its estimated footprint fits the memory budget
+        (settings.memory_budget_bytes) alongside what running crawls hold and are expected to reach. Workers are
+        paused rather than killed if memory runs short regardless.'''
         listener_worker = 'listener'
         logger = logg.default_logger(__name__)
 
         def __init__(self):
             self.MAXWORKERS = os.cpu_count() - 2      # Maximum available workers = no. cpus of machine - 2
             self.running = set()
+            self.workers = []
+            self.workers_started = 0
+            self.job_queue = JobQueue()
+            recovered = self.job_queue.recover()
+            self.logger.info(f'{recovered} interrupted job(s) re-queued.') if recovered else None
+            self.queue_watcher = DirectoryWatcher.create(settings.aqa_queue, self.logger)     # None: poll the queue
+            self.memory_budget = settings.memory_budget_bytes or int(memory.total() * settings.memory_budget_fraction)
+            self.logger.info(f'Memory budget {self.memory_budget / 1024 ** 3:.1f} GB.')
 
         def process_running(self, name: str) -> multiprocessing.Process:
             '''Checks if a named process is running.
@@ -37,49 +52,194 @@ class ProcessHandler:
                                       name=self.listener_worker, daemon=False)
                 self.launch_process(listener)
 
+        def ensure_workers(self):
+            '''Starts workers until there are MAXWORKERS - 1 (one worker's share is left to the listener).'''
+            while len(self.workers) < max(1, self.MAXWORKERS - 1):
+                self.workers_started += 1
+                worker = Worker(f'worker-{self.workers_started}', autoQA.autoQA)
+                self.logger.info(f'Started {worker.name}.')
+                self.workers.append(worker)
+
+        def running_crawls(self) -> list:
+            return [worker.job.crawl_id for worker in self.workers if worker.job]
+
+        def idle_worker(self) -> Worker:
+            return next((worker for worker in self.workers if worker.idle), None)
+
+        def finish_job(self, worker: Worker, error: str = None):
+            '''Marks a worker's job complete (or failed if error) and logs its predicted and actual runtime.
+            The job only leaves the queue if it refers to the same update time.'''
+            job = worker.job
+            worker.job = None
+            if worker.paused:       # it finished (or died) before reaching a checkpoint
+                worker.resume()
+            if error is None:
+                timing = self.job_queue.complete(job.crawl_id, job.updated)
+                self.logger.info(f'{job.crawl_id} complete on {worker.name}.{self.format_timing(timing)}')
+            else:
+                timing = self.job_queue.fail(job.crawl_id, job.updated, error)
+                self.logger.warning(f'{job.crawl_id} failed on {worker.name}: {error}.{self.format_timing(timing)}')
+
+        def collect_results(self):
+            '''Collects finished jobs from the workers. Workers which died are replaced (failing their job),
+            as are workers which reported that they should be recycled.'''
+            for worker in self.workers.copy():
+                result = worker.result()
+                if result:
+                    self.logger.info(f'{result["crawl_id"]} on {worker.name}: dispatch latency (submit to worker pick-up) '
+                                     f'{result["dispatch_latency"]:.3f}s, runtime {result["runtime"]:.0f}s, '
+                                     f'RSS {result["rss"] / 1024 ** 2:.0f} MB after {result["jobs"]} job(s).')
+                    self.finish_job(worker, result['error'])
+                    if result['recycle']:
+                        self.logger.info(f'Recycling {worker.name}.')
+                        worker.close()
+                        self.workers.remove(worker)
+                elif not worker.is_alive():
+                    exitcode = worker.process.exitcode
+                    self.logger.warning(f'{worker.name} dead (exit code {exitcode}). Replacing.')
+                    if worker.job:
+                        self.finish_job(worker, f'exit code {exitcode}')
+                    worker.close()
+                    self.workers.remove(worker)
+            self.ensure_workers()
+
         def prune_processes(self):
             '''Dead processes do not close themsleves so it is necessary to prune often.
-            If a running process is found to be dead, it is closed, remvoed from the running set
-            and if a corresponding crawl is in the queue with the same update time, it is removed.'''
+            If a running process is found to be dead, it is closed and remvoed from the running set.
+            Finished jobs are collected from the workers.'''
             self.logger.debug(f'Pruning running processes. {len(self.running)} running.')
             for process in self.running.copy():                 ## copy so not to remove from actual set.
                 if not process.is_alive():
                     self.logger.info(f'Process {process.name} dead. Closing and removing.')
                     process.close()
                     self.running.remove(process)
-                    if process.name in os.listdir(settings.aqa_queue):
-                        with open(process.queue_path, 'rb') as source:
-                            queued_issue = pickle.load(source)
-                        if queued_issue.data['updated'] == process.updated:
-                            os.system(f'rm {process.queue_path}')
-                            self.logger.info(f'Process {process.name} removed from queue.')
+            self.collect_results()
             self.ensure_listener()
+            self.regulate_memory()
+
+        def listener_rss(self) -> int:
+            return sum(memory.tree_rss(process.pid) for process in self.running if process.is_alive())
+
+        def memory_headroom(self) -> int:
+            '''Returns the bytes a new crawl may use: the budget less what the listener and workers hold and busy workers
+            are expected to reach, capped by MemAvailable less what they are still expected to grow by and
+            settings.memory_min_available_bytes.'''
+            held = self.listener_rss()
+            expected = held
+            for worker in self.workers:
+                held += worker.rss()
+                expected += worker.expected_rss()
+            growth = expected - held
+            return min(self.memory_budget - expected, memory.available() - growth - settings.memory_min_available_bytes)
+
+        def regulate_memory(self):
+            '''Pauses the most recently started busy worker if the workers and listener hold settings.memory_pause_fraction
+            of the budget or MemAvailable falls below settings.memory_min_available_bytes, so the others can finish and free
+            memory. The last running worker is never paused. Paused workers are resumed, oldest first, once held memory is
+            below settings.memory_resume_fraction of the budget and MemAvailable is above the minimum again, or when no
+            other worker is running. One worker is paused or resumed per call. Workers paused for longer than
+            settings.memory_pause_max_seconds are resumed regardless, and not paused again during that job.
+            Pausing is cooperative (helpers/pausing.py), so a paused worker never holds a lock the others wait on.'''
+            held = self.listener_rss() + sum(worker.rss() for worker in self.workers)
+            available = memory.available()
+            busy = [worker for worker in self.workers if worker.job and not worker.paused]
+            paused = [worker for worker in self.workers if worker.paused]
+            expired = [worker for worker in paused if time.time() - worker.paused_at > settings.memory_pause_max_seconds]
+            short = held >= self.memory_budget * settings.memory_pause_fraction or available < settings.memory_min_available_bytes
+            pausable = [worker for worker in busy if worker.pausable]
+            if expired:
+                worker = min(expired, key=lambda x: x.paused_at)
+                worker.resume()
+                worker.pausable = False
+                self.logger.warning(f'{worker.name} ({worker.job.crawl_id}) paused for over '
+                                    f'{settings.memory_pause_max_seconds}s. Resumed.')
+            elif short and len(busy) > 1 and pausable:
+                worker = max(pausable, key=lambda x: x.job_started)
+                worker.pause()
+                self.logger.warning(f'Memory short ({held / 1024 ** 3:.1f} GB held, {available / 1024 ** 3:.1f} GB available). '
+                                    f'Paused {worker.name} ({worker.job.crawl_id}).')
+            elif paused and (not busy or not short and held < self.memory_budget * settings.memory_resume_fraction):
+                worker = min(paused, key=lambda x: x.job_started)
+                worker.resume()
+                self.logger.info(f'Memory recovered ({held / 1024 ** 3:.1f} GB held, {available / 1024 ** 3:.1f} GB available). '
+                                 f'Resumed {worker.name} ({worker.job.crawl_id}).')
+
+        @staticmethod
+        def format_timing(timing) -> str:
+            '''Formats a job's (predicted, actual) runtime for the logs, so the cost model can be checked.'''
+            if not timing or timing[0] is None:
+                return ''
+            predicted, actual = timing
+            return f' Predicted runtime {predicted:.0f}s, actual {actual:.0f}s ({actual / max(predicted, 1):.2f}x).'
+
+        def wait(self, queue: bool = True):
+            '''Blocks until a running process exits, a worker finishes a job or (if queue) the queue directory changes.
+            Without inotify the queue is polled every settings.queue_poll_seconds. With it, waits are still capped at
+            settings.queue_wait_seconds as a safety net against missed events. While crawls are running waits are capped
+            at settings.memory_check_seconds.'''
+            waitables = [process.sentinel for process in self.running]
+            waitables += [worker.connection for worker in self.workers] + [worker.sentinel for worker in self.workers]
+            if queue and self.queue_watcher:
+                waitables.append(self.queue_watcher)
+            timeout = settings.queue_wait_seconds if self.queue_watcher or not queue else settings.queue_poll_seconds
+            if any(worker.job for worker in self.workers):     # memory is rechecked while crawls run
+                timeout = min(timeout, settings.memory_check_seconds)
+            ready = multiprocessing.connection.wait(waitables, timeout)
+            if self.queue_watcher in ready:
+                self.logger.debug(f'Queue changed: {self.queue_watcher.drain()}')
 
         def launch_process(self, process: multiprocessing.Process):
-            '''Takes a multiprocessing Process object and laucnhing it in the context of the application.
-            If there is no free worker, it will wait and prune every 5 seconds until one becomes available.
+            '''Takes a multiprocessing Process object (e.g. the listener) and laucnhing it in the context of the application.
             The process is started and added to the running set.'''
-            while len(self.running) >= self.MAXWORKERS:
-                self.logger.debug('Too many processes running to add another. Pruning and trying again')
-                time.sleep(5)
-                self.prune_processes()
             self.logger.info(f'Launching process {process}')
             process.start()
             self.running.add(process)
 
+        def wait_for_worker(self) -> Worker:
+            '''Returns an idle worker, waiting for one to finish its job if they are all busy.'''
+            worker = self.idle_worker()
+            while not worker:
+                self.logger.debug('All workers busy. Waiting for one to finish')
+                self.wait(queue=False)
+                self.prune_processes()
+                worker = self.idle_worker()
+            return worker
+
+        def dispatch(self, job):
+            '''Sends a claimed job to an idle worker.'''
+            worker = self.wait_for_worker()
+            self.logger.info(f'Dispatching {job.crawl_id} to {worker.name}')
+            worker.submit(job)
+
+        def claim(self):
+            '''Claims the next job from the queue which fits in memory (see memory_headroom). Nothing is claimed while a
+            worker is paused. If no crawl is running, the next job is claimed whatever its footprint.'''
+            if any(worker.paused for worker in self.workers):
+                return None
+            max_bytes = None
+            if any(worker.job for worker in self.workers):
+                max_bytes = max(0, self.memory_headroom())
+            large_slots = max(1, int(self.MAXWORKERS * settings.job_large_share))
+            job = self.job_queue.claim(exclude=self.running_crawls(), large_slots=large_slots, max_bytes=max_bytes)
+            if not job and max_bytes is not None:
+                self.logger.debug(f'No queued crawl fits in {max_bytes / 1024 ** 2:.0f} MB.')
+            return job
+
         def get_crawl_from_queue(self):
-            '''Checks the queue for a new crawl. If the queue is empty, it will wait, prune and recheck every five seconds.
-            When there is a crawl it will return the crawl ID'''
-            queue = os.listdir(settings.aqa_queue)
-            self.logger.info(f'{len(queue)} crawls in the queue')
+            '''Claims the next crawl from the job queue (shortest expected job first, see JobQueue). If the queue is empty, it will wait for the queue to change
+            (or a process to exit), prune and recheck. Crawls which do not fit in memory are deferred the same way.
+            When there is a crawl it will return its Job (crawl ID, update time, sub-processes)'''
+            self.logger.info(f'Queue: {self.job_queue.counts()}')
             self.logger.info('Getting next crawl from queue.')
-            crawl_id = next((crawl_id for crawl_id in queue if not self.process_running(crawl_id)), None)
-            while not crawl_id:
-                self.logger.debug('No crawls in the queue. Waiting and retrying')
-                time.sleep(5)
+            job = self.claim()
+            while not job:
+                self.logger.debug('No crawls in the queue (or none fit in memory). Waiting and retrying')
+                self.wait()
                 self.prune_processes()
-                crawl_id = next((crawl_id for crawl_id in os.listdir(settings.aqa_queue) if not self.process_running(crawl_id)), None)
-            return crawl_id
+                job = self.claim()
+            self.logger.info(f'Claimed {job.crawl_id}. Estimated runtime {job.estimated_seconds or 0:.0f}s, '
+                             f'memory {(job.estimated_bytes or 0) / 1024 ** 2:.0f} MB.')
+            return job
 
 
 if __name__ == '__main__':
@@ -115,20 +275,9 @@ if __name__ == '__main__':
             handler.ensure_listener()
             handler.prune_processes()
 
-            crawl_id = handler.get_crawl_from_queue()
-            queue_path = os.path.join(settings.aqa_queue, crawl_id)
-
-            # The queued issue is loaded in order to get the update time and associate it with the process.
-            # This allows the prune function to remove the crawl from the queue if it refers to the same update
-            with open(queue_path, 'rb') as source:
-                issue = pickle.load(source)
-
-            logger.info(f'Configuring autoQA process for {crawl_id}')
-            process = multiprocessing.Process(target=autoQA.autoQA, args=(crawl_id,),
-                                             name=crawl_id, daemon=False)
-            process.updated = issue.data['updated']
-            process.queue_path = queue_path
-            handler.logger.info(f'Launching autoQA process for {process.name}')
-            handler.launch_process(process)
+            # A worker is free before a crawl is claimed, so the claim sees the queue as it is at dispatch
+            handler.wait_for_worker()
+            job = handler.get_crawl_from_queue()
+            handler.dispatch(job)
         except:
             continue
\ No newline at end of file
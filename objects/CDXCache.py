@@ -0,0 +1,65 @@
+import os
+import time
+import sqlite3
+
+import settings
+from helpers.urls import canonical
+
+
+class CDXCache:
+    '''Persistent cache of CDX index presence checks shared by all processes and crawls.
+    Entries are keyed by CDX root and a canonical URL key (helpers/urls.canonical) so http/https/www variants share one.
+    Positive and negative answers expire after their own TTLs (a URL missing from the index today may be
+    captured tomorrow, so negatives are kept for less time).
+    Backed by SQLite in WAL mode so concurrent autoQA processes can read and write it.
+
+    :param: path - SQLite database path (defaults to settings.cdx_cache_path)
+    :param: positive_ttl - seconds a "present" answer is trusted
+    :param: negative_ttl - seconds a "not present" answer is trusted'''
+
+    def __init__(self, path: str = settings.cdx_cache_path, positive_ttl: int = settings.cdx_cache_positive_ttl,
+                 negative_ttl: int = settings.cdx_cache_negative_ttl):
+        self.path = path
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cdx_cache (cdx_root TEXT NOT NULL, url_key TEXT NOT NULL, '
+                                'present INTEGER NOT NULL, checked_at REAL NOT NULL, PRIMARY KEY (cdx_root, url_key))')
+        self.connection.commit()
+
+    def get_many(self, urls, cdx_root: str = settings.qa_cdx_root) -> dict:
+        '''Returns a dict of url: True/False for the URLs with an unexpired answer.'''
+        keys = {}
+        for url in urls:
+            keys.setdefault(canonical(url), []).append(url)
+        key_list = list(keys)
+        now = time.time()
+        cached = {}
+        for i in range(0, len(key_list), 500):      # stays under SQLite's bound parameter limit
+            chunk = key_list[i:i + 500]
+            rows = self.connection.execute(
+                f'SELECT url_key, present, checked_at FROM cdx_cache WHERE cdx_root = ? '
+                f'AND url_key IN ({",".join("?" * len(chunk))})', [cdx_root] + chunk)
+            for key, present, checked_at in rows:
+                if now - checked_at < (self.positive_ttl if present else self.negative_ttl):
+                    cached.update((url, bool(present)) for url in keys[key])
+        self.hits += len(cached)
+        self.misses += sum(len(x) for x in keys.values()) - len(cached)
+        return cached
+
+    def put_many(self, results: dict, cdx_root: str = settings.qa_cdx_root):
+        '''Stores a dict of url: True/False.'''
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO cdx_cache VALUES (?, ?, ?, ?)',
+                                        [(cdx_root, canonical(url), int(present), now) for url, present in results.items()])
+
+    def stats(self) -> str:
+        return f'{self.hits} hit(s), {self.misses} miss(es)'
+
+    def close(self):
+        self.connection.close()
@@ -1,24 +1,35 @@
 import os
+import hashlib
+import itertools
 import pandas as pd
 import logging
+from functools import cached_property
 import boto3
 
 import settings
 from env import secrets
 
-import gwa_aws
 import gwa_jira
-import gwa_qa
+
+from helpers import s3, crawl_log_store, warc, urls
+from objects.S3Cache import S3Cache
+from objects.ScopeMatcher import ScopeMatcher
+from objects.RateLimiter import RateLimiter
 
 main = logging.getLogger('__main__')
 
 class Crawl:
     '''Crawl object.
     Loads data and metadata associated with a crawl.
-    Currently jira issue and logs.
+    Currently jira issue, logs and an index of the crawl's WARC records.
     Initiates a folder structure associated with the crawl.
 
-    #TODO: XML1e, CDXs, WARCs.
+    issue, log_files, log_store, warc_index, scope, scope_matcher and homepage are loaded lazily on first access and memoized,
+    so each process only pays for the data it uses. refresh_issue() and refresh_logs() invalidate them.
+    crawl_log is not memoized: the whole log as one string can take gigabytes, and its parts are re-read from the
+    local S3Cache on each access.
+
+    #TODO: XML1e.
     :param: crawl_id - TNA crawl ID'''
 
     aws_session = boto3.Session(
@@ -29,16 +40,83 @@ class Crawl:
         self.id = int(crawl_id)
         self.directory = os.path.join(settings.aqa_dir, str(self.id))
         self.logger = logging.getLogger(f'__main__.{self.id}')  # gets logger if exists, if not creates unconfigured logger
-        self.issue = self.load_issue()
-        self.add_logs_to_description()
-        self.log_files = self.load_logs(verbose=True)
-        self.scope = self.load_scope()
-
-    def add_logs_to_description(self):
+        self.s3client = self.aws_session.client('s3')     # boto3 clients are thread-safe so one is shared by all S3 fetches
+        self.cache = S3Cache()                  # local ETag-keyed cache shared by reloads, processes and re-runs
+
+    @cached_property
+    def issue(self) -> gwa_jira.Issue:
+        issue = self.load_issue()
+        self.add_logs_to_description(issue)
+        return issue
+
+    @cached_property
+    def log_files(self) -> pd.core.frame.DataFrame:
+        return self.load_logs(verbose=True)
+
+    @property
+    def crawl_log(self) -> str:
+        return self.get_crawl_log()
+
+    @cached_property
+    def scope(self) -> tuple:
+        return self.load_scope()
+
+    @cached_property
+    def homepage(self) -> str:
+        self.load_scope()
+        return self.__dict__['homepage']
+
+    @cached_property
+    def log_store(self) -> str:
+        '''Path to the crawl log parsed into a columnar (Parquet) store in the crawl directory.
+        It is built once and only rebuilt when the crawl.log parts change.'''
+        path = os.path.join(self.directory, 'crawl-log.parquet')
+        fingerprint = self.crawl_log_fingerprint()
+        if crawl_log_store.fingerprint(path) != fingerprint:
+            self.logger.info('Building crawl log store.')
+            rows = crawl_log_store.build(self.iter_crawl_log(), path, fingerprint)
+            self.logger.info(f'Crawl log store built. {rows} line(s).')
+        return path
+
+    @cached_property
+    def warc_index(self) -> dict:
+        '''Dict of url: (warc key, offset, length) for the successful PDF captures in the crawl's WARCs,
+        built from the crawl's CDX files. Only PDFs are kept (they are all PDFflash reads from WARCs), so the index
+        stays small for crawls with millions of captures.'''
+        warcs = s3.list_objects(self.s3client, secrets.data_bucket, f'{settings.warc_prefix}tna-{self.id}')
+        warc_keys = [x['Key'] for x in warcs if x['Key'].endswith(('.warc', '.warc.gz'))]
+        cdxs = s3.list_objects(self.s3client, secrets.data_bucket, f'{settings.cdx_prefix}tna-{self.id}')
+        cdxs = [x for x in cdxs if x['Key'].endswith(('.cdx', '.cdx.gz', '.cdxj', '.cdxj.gz'))]
+        self.logger.info(f'Indexing {len(warc_keys)} WARC(s) from {len(cdxs)} CDX file(s).')
+
+        lines = itertools.chain.from_iterable(
+            s3.iter_object_lines(self.s3client, secrets.data_bucket, x['Key'], self.cache, x['ETag']) for x in cdxs)
+        index = warc.build_index(lines, warc_keys, mimes=('application/pdf',))
+        self.logger.info(f'{len(index)} PDF URL(s) indexed in WARCs.')
+        return index
+
+    @cached_property
+    def scope_matcher(self) -> ScopeMatcher:
+        return ScopeMatcher.from_crawl(self)
+
+    def invalidate(self, *attributes: str):
+        '''Drops memoized attributes so they are reloaded on next access.'''
+        for attribute in attributes:
+            self.__dict__.pop(attribute, None)
+
+    def refresh_issue(self):
+        '''Reloads the Jira issue on next access, keeping logs and scope.'''
+        self.invalidate('issue')
+
+    def refresh_logs(self):
+        '''Reloads the S3 log listing, crawl log and scope on next access.'''
+        self.invalidate('log_files', 'log_store', 'warc_index', 'scope', 'homepage', 'scope_matcher')
+
+    def add_logs_to_description(self, issue: gwa_jira.Issue):
         complete_label = 'aqa-logs-in-description'
-        if complete_label in self.issue.labels:
+        if complete_label in issue.labels:
             return None
-        self.issue.reload()
+        issue.reload()
         s3_aqa_logs = f'https://ENTER-YOUR-DIRECTORY&prefix={self.id}/'
 
         desc_seperator = {'type': 'paragraph',
@@ -55,17 +133,30 @@ class Crawl:
                                                'attrs': {'href': s3_aqa_logs}}]}]}
 
 
-        desc = self.issue.data['description']
+        desc = issue.data['description']
         desc['content'] += [desc_seperator, logs_desc_link]
-        self.issue.update_field('description', desc, 'set')
-        self.issue.add_label(complete_label)
+        issue.update_field('description', desc, 'set')
+        issue.add_label(complete_label)
+
+    def __getstate__(self):
+        '''boto3 clients cannot be pickled (e.g. when processes save crawl.pkl) so the client is dropped.'''
+        state = self.__dict__.copy()
+        state.pop('s3client', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.s3client = self.aws_session.client('s3')
 
     def reload(self):
-        self.__init__(self.id)
+        '''Reloads everything on next access.'''
+        self.refresh_issue()
+        self.refresh_logs()
 
     def load_issue(self) -> gwa_jira.Issue:
         '''Connects to Jira and loads issue data'''
         jql = f'labels = client_ref:{self.id}'
+        RateLimiter.get('jira').acquire()
         results = gwa_jira.get_all(jql=jql, auth=secrets.JIRAauth, return_objects=True)
         if len(results) > 1:
             dupe = 'duplicate'
@@ -80,45 +171,71 @@ class Crawl:
         elif len(results) == 0:
             raise Exception(f'No Results for {jql}')
         else:
-            self.issue = results[0]
-            return self.issue
+            return results[0]
 
     def load_logs(self, verbose: bool = True) -> pd.core.frame.DataFrame:
         '''Gets log info from S3.
         Returns a Dataframe with logs associated with the crawl.'''
-        s3client = self.aws_session.client('s3')
-
-        logs_response = s3client.list_objects_v2(Bucket=secrets.data_bucket, Prefix=f'crawl-logs/tna-{self.id}')
-        if logs_response.get('IsTruncated'):
-            raise Exception('Crawl has too many log files.')
-        if not logs_response.get('Contents'):
+        contents = s3.list_objects(self.s3client, secrets.data_bucket, f'crawl-logs/tna-{self.id}')
+        if not contents:
             raise Exception('No available log files.')
 
-        self.log_files = pd.DataFrame(logs_response.get('Contents'))
-        self.crawl_log = self.get_crawl_log()
+        self.log_files = pd.DataFrame(contents)
+        self.logger.info(f'{len(self.log_files)} log file(s) listed.') if verbose else None
         return self.log_files
 
-    def get_crawl_log(self, verbose: bool = True) -> str:
-        '''Loads and combines the crawl's crawl logs
-        into a single string log.'''
+    def log_etags(self) -> dict:
+        '''Returns a dict of log file key: ETag from the S3 listing.'''
+        return dict(zip(self.log_files['Key'], self.log_files['ETag']))
+
+    def log_keys(self, pattern: str) -> list:
+        '''Returns the S3 keys of log files matching a regex pattern.'''
+        return list(self.log_files.loc[self.log_files['Key'].str.contains(pattern, na=False), 'Key'])
 
-        crawl_logs = self.log_files[self.log_files['Key'].str.contains('/crawl\.log', na=False)]
+    def crawl_log_keys(self) -> list:
+        '''Returns the S3 keys of the crawl's crawl.log parts (plain or gzipped).'''
+        crawl_logs = self.log_keys('/crawl\\.log')
         if len(crawl_logs) == 0:
             raise Exception('No crawl logs.')
+        return crawl_logs
+
+    def iter_crawl_log(self):
+        '''Streams the crawl's crawl logs line by line, part by part.
+        S3 objects are read in chunks and gzipped parts are decompressed on the fly,
+        so the whole log is never held in memory.'''
+        etags = self.log_etags()
+        for key in self.crawl_log_keys():
+            self.logger.debug(f'Streaming {key}')
+            yield from s3.iter_object_lines(self.s3client, secrets.data_bucket, key, self.cache, etags[key])
+
+    def crawl_log_fingerprint(self) -> str:
+        '''Returns a hash identifying the current set of crawl.log parts (by key and ETag).'''
+        etags = self.log_etags()
+        return hashlib.sha256('\n'.join(f'{key} {etags[key]}' for key in self.crawl_log_keys()).encode()).hexdigest()
+
+    def read_crawl_log(self, columns: list = None, filters: list = None) -> pd.core.frame.DataFrame:
+        '''Reads columns of the crawl log store (see helpers/crawl_log_store.py), optionally filtered
+        e.g. crawl.read_crawl_log(['url'], [('status', '>=', 200), ('status', '<', 400)])'''
+        return crawl_log_store.read(self.log_store, columns, filters)
 
-        crawl_logs = crawl_logs.apply(lambda x: gwa_aws.open_file(secrets.data_bucket, x['Key'], self.aws_session).decode(), axis=1)
-        self.crawl_log = '\n'.join(crawl_logs)
-
-        return self.crawl_log
-
-    def load_scope(self):                   ####TO CLEAN
-        '''Loads Scoping Rules from Specifications.'''
+    def get_crawl_log(self, verbose: bool = True) -> str:
+        '''Loads and combines the crawl's crawl logs
+        into a single string log. Kept for processes which need the whole log as a string
+        (e.g. gwa_qa.crawl_log_rud); prefer iter_crawl_log() otherwise.
+        Parts are downloaded in parallel.'''
+        parts = s3.fetch_many(self.s3client, secrets.data_bucket, self.crawl_log_keys(), self.cache, self.log_etags())
+        return '\n'.join('\n'.join(s3.iter_lines(s3.gunzip_chunks([part]))) for part in parts.values())
+
+    def load_scope(self):
+        '''Loads Scoping Rules from Specifications.
+        All specification files are downloaded in parallel.'''
+        also_files = self.log_keys('also-in-scope\\.txt')
+        scope_files = self.log_keys('associated\\.txt|also-capture\\.txt')
+        files = s3.fetch_many(self.s3client, secrets.data_bucket, also_files + scope_files, self.cache, self.log_etags())
 
-        also_files = list(self.log_files.loc[
-                    self.log_files['Key'].str.contains('also-in-scope.txt'), 'Key'])
         also = ''
         for file in also_files:
-            also += gwa_aws.open_file(bucket=secrets.data_bucket, path=file, aws_session=self.aws_session).decode()
+            also += files[file].decode()
             also += '\n'
         also = set([x for x in also.split('\n') if x])
         patterns = set([x.split('://')[1] for x in also])
@@ -127,15 +244,10 @@ class Crawl:
             also.add('http://'+patt)
 
         self.scope = list(also)
-        self.homepage = gwa_qa.clean_url(self.scope[0])
-
-        scopes = list(self.log_files.loc[
-                    self.log_files['Key'].str.contains('associated.txt|also-capture.txt'), 'Key'])
+        self.homepage = urls.strip_protocol(self.scope[0])
 
-        for x in scopes:
-            x = gwa_aws.open_file(bucket=secrets.data_bucket, path=x, aws_session=self.aws_session).decode()
-            x = x.split('\n')
-            self.scope += x
+        for file in scope_files:
+            self.scope += files[file].decode().split('\n')
 
         self.scope = tuple(self.scope)
 
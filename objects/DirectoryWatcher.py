@@ -0,0 +1,64 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+
+# inotify event masks (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+event_header = struct.Struct('iIII')        # wd, mask, cookie, len (then len bytes of NUL-padded name)
+
+
+class DirectoryWatcher:
+    '''Watches a directory for entries being written, created, moved or deleted, using Linux inotify (via ctypes).
+    It has a fileno() so it can be waited on with select or multiprocessing.connection.wait alongside
+    process sentinels. Raises OSError if inotify is unavailable (see create for a fallback).
+
+    :param: path - directory to watch'''
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, path: str):
+        self.path = path
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_init1 failed: {os.strerror(ctypes.get_errno())}')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch {path} failed: {os.strerror(errno)}')
+
+    @classmethod
+    def create(cls, path: str, logger=None):
+        '''Returns a watcher for path, or None if inotify is unavailable (callers should then poll).'''
+        try:
+            return cls(path)
+        except (OSError, AttributeError) as e:       # AttributeError: libc without inotify (not Linux)
+            if logger:
+                logger.warning(f'Cannot watch {path} ({e}). Falling back to polling.')
+            return None
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def drain(self) -> list:
+        '''Reads all pending events, returning the names of the entries they concern.'''
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = event_header.unpack_from(data, offset)
+                offset += event_header.size
+                names.append(data[offset:offset + length].rstrip(b'\0').decode(errors='replace'))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
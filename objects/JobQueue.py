@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import sqlite3
+from collections import namedtuple
+
+import settings
+
+Job = namedtuple('Job', ['crawl_id', 'updated', 'processes', 'priority', 'attempts', 'estimated_seconds', 'estimated_bytes'])
+
+schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    crawl_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,                -- queued, running, done or failed
+    updated TEXT NOT NULL,              -- the Jira issue's updated time when queued
+    processes TEXT NOT NULL,            -- JSON list of sub-processes selected when queued
+    priority REAL NOT NULL DEFAULT 0,   -- higher runs first
+    estimated_seconds REAL,             -- see helpers/job_cost.py
+    estimated_bytes REAL,               -- peak memory over an idle worker's, see helpers/job_cost.py
+    signals TEXT,                       -- JSON of the signals the estimate was made from
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued_at REAL NOT NULL,
+    claimed_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state_priority ON jobs (state, priority DESC, enqueued_at);
+CREATE TABLE IF NOT EXISTS attempts (
+    id INTEGER PRIMARY KEY,
+    crawl_id TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    pid INTEGER,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    estimated_seconds REAL,
+    outcome TEXT NOT NULL,              -- running, done, failed or abandoned
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS attempts_crawl_id ON attempts (crawl_id, started_at);
+'''
+added_columns = {'jobs': {'estimated_seconds': 'REAL', 'estimated_bytes': 'REAL', 'signals': 'TEXT'},
+                 'attempts': {'estimated_seconds': 'REAL'}}
+
+
+class JobQueue:
+    '''Queue of crawls waiting for autoQA, shared by the JIRA listener and the process handler.
+    Backed by SQLite in WAL mode. Each crawl has one job row holding only what scheduling needs, moved through
+    queued -> running -> done/failed by single transactions. Every run is recorded in the attempts table.
+
+    Jobs are claimed shortest expected job first: by estimated runtime less settings.job_aging seconds per second
+    waited. Jobs waiting longer than settings.job_max_wait go first, and large jobs (settings.job_large_seconds)
+    can be limited to a number of workers so small tickets are not stuck behind them. Claims can be limited to jobs
+    whose estimated memory footprint fits what is free; a starved job which does not fit blocks claims until it does.
+
+    Writers touch a signal file in the queue directory so a process watching it (see DirectoryWatcher) wakes up.
+
+    :param: path - SQLite database path (defaults to settings.job_queue_path)'''
+
+    def __init__(self, path: str = settings.job_queue_path):
+        self.path = path
+        self.signal_path = os.path.join(os.path.dirname(path), 'changed')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.open()
+        self.connection.executescript(schema)
+        self.migrate()
+
+    def open(self):
+        '''Connects to the database. Forked children must reconnect, as SQLite connections cannot be shared
+        across a fork.'''
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)     # transactions are explicit
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+    def migrate(self):
+        '''Adds columns missing from databases created by earlier versions.'''
+        for table, columns in added_columns.items():
+            existing = {row[1] for row in self.execute(f'PRAGMA table_info({table})')}
+            for column, column_type in columns.items():
+                if column not in existing:
+                    self.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        if self.pid != os.getpid():
+            self.open()
+        return self.connection.execute(sql, parameters)
+
+    def transaction(self, change):
+        '''Runs change() in an immediate (write-locked) transaction, returning its result.'''
+        self.execute('BEGIN IMMEDIATE')
+        try:
+            result = change()
+        except BaseException:
+            self.execute('ROLLBACK')
+            raise
+        self.execute('COMMIT')
+        return result
+
+    def signal(self):
+        with open(self.signal_path, 'w'):
+            pass
+
+    def enqueue(self, crawl_id: str, updated: str, processes: list, priority: float = 0,
+                estimated_seconds: float = None, estimated_bytes: float = None, signals: dict = None) -> bool:
+        '''Queues a crawl for the given issue update. Returns False (and does nothing) if that update is already
+        queued, running or done. A newer update of a crawl (or a failed one) queues it again.'''
+        def change():
+            row = self.execute('SELECT state, updated FROM jobs WHERE crawl_id = ?', (crawl_id,)).fetchone()
+            if row and row[0] in ('queued', 'running', 'done') and row[1] == updated:
+                return False
+            self.execute('INSERT INTO jobs (crawl_id, state, updated, processes, priority, estimated_seconds, estimated_bytes, '
+                         "signals, enqueued_at) VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (crawl_id) DO UPDATE SET "
+                         "state = 'queued', updated = excluded.updated, processes = excluded.processes, "
+                         'priority = excluded.priority, estimated_seconds = excluded.estimated_seconds, '
+                         'estimated_bytes = excluded.estimated_bytes, signals = excluded.signals, '
+                         'enqueued_at = excluded.enqueued_at, attempts = 0',
+                         (crawl_id, updated, json.dumps(processes), priority, estimated_seconds, estimated_bytes,
+                          json.dumps(signals), time.time()))
+            return True
+        queued = self.transaction(change)
+        if queued:
+            self.signal()
+        return queued
+
+    def remove(self, crawl_id: str) -> bool:
+        '''Removes a crawl from the queue (e.g. its ticket is Done). A running job is left to finish.
+        Returns True if there was a job to remove.'''
+        removed = self.execute('DELETE FROM jobs WHERE crawl_id = ?', (crawl_id,)).rowcount > 0
+        if removed:
+            self.signal()
+        return removed
+
+    def claim(self, exclude=(), large_slots: int = None, max_bytes: float = None) -> Job:
+        '''Atomically takes the next queued job (see the class docstring for the order), marking it running.
+        Crawls in exclude (e.g. already running) are skipped. If large_slots large jobs are already running,
+        only small or starved jobs are considered. If max_bytes is given, only jobs estimated to need at most that
+        much memory are. Returns None if there is nothing to claim.'''
+        exclude = list(exclude)
+        def change():
+            now = time.time()
+            starved = now - settings.job_max_wait
+            conditions = f"state = 'queued' AND crawl_id NOT IN ({','.join('?' * len(exclude))})"
+            parameters = exclude
+            if large_slots is not None:
+                large_running = self.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running' AND estimated_seconds >= ?",
+                                             (settings.job_large_seconds,)).fetchone()[0]
+                if large_running >= large_slots:
+                    conditions += ' AND (COALESCE(estimated_seconds, 0) < ? OR enqueued_at < ?)'
+                    parameters = parameters + [settings.job_large_seconds, starved]
+            if max_bytes is not None:
+                conditions += ' AND (COALESCE(estimated_bytes, 0) <= ? OR enqueued_at < ?)'
+                parameters = parameters + [max_bytes, starved]
+            row = self.execute(f'SELECT crawl_id, updated, processes, priority, attempts, estimated_seconds, estimated_bytes '
+                               f'FROM jobs '
+                               f'WHERE {conditions} ORDER BY priority DESC, enqueued_at < ? DESC, '
+                               f'CASE WHEN enqueued_at < ? THEN enqueued_at '
+                               f'ELSE COALESCE(estimated_seconds, 0) - ? * (? - enqueued_at) END LIMIT 1',
+                               parameters + [starved, starved, settings.job_aging, now]).fetchone()
+            if not row or (max_bytes is not None and (row[6] or 0) > max_bytes):       # nothing, or a starved job waiting for memory
+                return None
+            self.execute("UPDATE jobs SET state = 'running', claimed_at = ?, attempts = attempts + 1 WHERE crawl_id = ?",
+                         (now, row[0]))
+            self.execute('INSERT INTO attempts (crawl_id, updated, pid, started_at, estimated_seconds, outcome) '
+                         "VALUES (?, ?, ?, ?, ?, 'running')", (row[0], row[1], os.getpid(), now, row[5]))
+            return Job(row[0], row[1], json.loads(row[2]), row[3], row[4] + 1, row[5], row[6])
+        return self.transaction(change)
+
+    def finish(self, crawl_id: str, updated: str, outcome: str, error: str = None) -> tuple:
+        '''Records the end of a crawl's running attempt. The job itself only moves on if it still refers to the
+        same issue update (it may have been queued again meanwhile).
+        Failed jobs are queued again until they have had settings.job_max_attempts attempts.
+        Returns the attempt's (estimated seconds, actual seconds), or None if no attempt was running.'''
+        def change():
+            now = time.time()
+            attempt = self.execute("SELECT estimated_seconds, started_at FROM attempts "
+                                   "WHERE crawl_id = ? AND updated = ? AND outcome = 'running'", (crawl_id, updated)).fetchone()
+            self.execute('UPDATE attempts SET finished_at = ?, outcome = ?, error = ? '
+                         "WHERE crawl_id = ? AND updated = ? AND outcome = 'running'", (now, outcome, error, crawl_id, updated))
+            if outcome == 'done':
+                self.execute("UPDATE jobs SET state = 'done', finished_at = ? "
+                             "WHERE crawl_id = ? AND updated = ? AND state = 'running'", (now, crawl_id, updated))
+            else:
+                self.execute("UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, finished_at = ? "
+                             "WHERE crawl_id = ? AND updated = ? AND state = 'running'",
+                             (settings.job_max_attempts, now, crawl_id, updated))
+            return (attempt[0], now - attempt[1]) if attempt else None
+        return self.transaction(change)
+
+    def complete(self, crawl_id: str, updated: str) -> tuple:
+        return self.finish(crawl_id, updated, 'done')
+
+    def fail(self, crawl_id: str, updated: str, error: str) -> tuple:
+        return self.finish(crawl_id, updated, 'failed', error)
+
+    def recover(self) -> int:
+        '''Queues again jobs left running by a handler which stopped (their workers went with it).
+        Returns the number of jobs recovered.'''
+        def change():
+            self.execute("UPDATE attempts SET finished_at = ?, outcome = 'abandoned' WHERE outcome = 'running'", (time.time(),))
+            return self.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'").rowcount
+        return self.transaction(change)
+
+    def get(self, crawl_id: str) -> dict:
+        '''Returns a crawl's job as a dict, or None.'''
+        cursor = self.execute('SELECT * FROM jobs WHERE crawl_id = ?', (crawl_id,))
+        row = cursor.fetchone()
+        return dict(zip([x[0] for x in cursor.description], row)) if row else None
+
+    def counts(self) -> dict:
+        '''Returns the number of jobs in each state.'''
+        return dict(self.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def close(self):
+        self.connection.close()
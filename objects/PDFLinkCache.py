@@ -0,0 +1,55 @@
+import os
+import json
+import time
+import sqlite3
+
+import settings
+
+
+class PDFLinkCache:
+    '''Persistent cache of URLs extracted from PDFs, keyed by the content digest Heritrix records in the crawl log
+    (e.g. sha1:...). Identical PDFs in later crawls (or at other URLs) are looked up instead of parsed.
+    Backed by SQLite in WAL mode so concurrent autoQA processes can share it.
+    Hit and miss counts are kept per instance.
+
+    :param: path - SQLite database path (defaults to settings.pdf_link_cache_path)'''
+
+    def __init__(self, path: str = settings.pdf_link_cache_path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pdf_links '
+                                '(digest TEXT PRIMARY KEY, urls TEXT NOT NULL, cached_at REAL NOT NULL)')
+        self.connection.commit()
+
+    def get_many(self, digests) -> dict:
+        '''Returns a dict of digest: list of URLs for the digests which are cached.'''
+        digests = list(set(digests))
+        cached = {}
+        for i in range(0, len(digests), 500):      # stays under SQLite's bound parameter limit
+            chunk = digests[i:i + 500]
+            rows = self.connection.execute(
+                f'SELECT digest, urls FROM pdf_links WHERE digest IN ({",".join("?" * len(chunk))})', chunk)
+            cached.update((digest, json.loads(urls)) for digest, urls in rows)
+        self.hits += len(cached)
+        self.misses += len(digests) - len(cached)
+        return cached
+
+    def put(self, digest: str, urls: list):
+        '''Stores the URLs extracted from a PDF.'''
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO pdf_links VALUES (?, ?, ?)',
+                                    (digest, json.dumps(sorted(set(urls))), time.time()))
+
+    def hit_rate(self) -> float:
+        looked_up = self.hits + self.misses
+        return self.hits / looked_up if looked_up else 0.0
+
+    def stats(self) -> str:
+        return f'{self.hits} hit(s), {self.misses} miss(es) ({self.hit_rate():.0%} hit rate)'
+
+    def close(self):
+        self.connection.close()
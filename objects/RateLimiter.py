@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import threading
+
+import settings
+from helpers import pausing
+
+
+class RateLimiter:
+    '''Token bucket shared by every process on the machine.
+    The bucket's state lives in a small file under settings.rate_limit_dir which is updated under an exclusive flock,
+    so all autoQA processes (and their threads) draw from one budget per endpoint.
+    The refill rate of an adaptive bucket adapts: it is halved when the endpoint reports throttling or server errors
+    (429/5xx), and climbs back towards the configured rate on success. Buckets shared by many unrelated hosts
+    (e.g. 'live') are not adaptive, as one failing site would slow requests to every other.
+
+    :param: name - bucket name, e.g. 'cdx' (see settings.rate_limits)
+    :param: rate - maximum requests per second
+    :param: burst - maximum tokens that can be saved up
+    :param: adaptive - whether report() adapts the rate'''
+
+    registry = {}
+    registry_lock = threading.Lock()
+
+    def __init__(self, name: str, rate: float, burst: float = None, directory: str = settings.rate_limit_dir,
+                 adaptive: bool = True):
+        self.name = name
+        self.adaptive = adaptive
+        self.max_rate = rate
+        self.min_rate = rate * settings.rate_limit_min_fraction
+        self.burst = burst or max(1.0, rate)
+        self.lock = threading.Lock()        # flock does not exclude threads sharing one file descriptor
+        self.path = os.path.join(directory, f'{name}.json')
+        os.makedirs(directory, exist_ok=True)
+        self.open()
+
+    def open(self):
+        '''Opens the state file. Forked children must reopen it, as flock does not exclude processes
+        sharing an inherited file descriptor.'''
+        self.pid = os.getpid()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    @classmethod
+    def get(cls, name: str):
+        '''Returns this process's limiter for a named bucket in settings.rate_limits.'''
+        with cls.registry_lock:
+            if name not in cls.registry:
+                cls.registry[name] = cls(name, settings.rate_limits[name], adaptive=name in settings.adaptive_rate_limits)
+            return cls.registry[name]
+
+    def update(self, change):
+        '''Refills the shared state then applies change(state) to it under the lock, returning its result.'''
+        with self.lock:
+            if self.pid != os.getpid():
+                self.open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                raw = os.pread(self.fd, 4096, 0)
+                try:
+                    state = json.loads(raw)
+                except ValueError:
+                    state = {'tokens': self.burst, 'updated': time.time(), 'rate': self.max_rate}
+                now = time.time()
+                state['rate'] = min(state['rate'], self.max_rate) if self.adaptive else self.max_rate    # in case settings changed
+                state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * state['rate'])
+                state['updated'] = now
+                result = change(state)
+                raw = json.dumps(state).encode()
+                os.ftruncate(self.fd, 0)
+                os.pwrite(self.fd, raw, 0)
+                return result
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def try_acquire(self) -> float:
+        '''Takes a token if one is available, returning 0. Otherwise returns the seconds to wait before retrying.
+        Waits first if the worker is paused (see helpers/pausing.py), before taking the lock.'''
+        pausing.checkpoint()
+        def take(state):
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return 0.0
+            return (1 - state['tokens']) / state['rate']
+        return self.update(take)
+
+    def acquire(self):
+        '''Blocks until a token is available.'''
+        while (wait := self.try_acquire()) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        '''Waits (without blocking the event loop) until a token is available.'''
+        while (wait := self.try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+    def report(self, status_code: int):
+        '''Adapts the shared rate to an endpoint's response: halved on 429/5xx, increased slowly otherwise.
+        Does nothing if the bucket is not adaptive.'''
+        if not self.adaptive:
+            return
+        def adapt(state):
+            if status_code == 429 or status_code >= 500:
+                state['rate'] = max(self.min_rate, state['rate'] / 2)
+            elif state['rate'] < self.max_rate:
+                state['rate'] = min(self.max_rate, state['rate'] + self.max_rate * settings.rate_limit_recovery)
+        self.update(adapt)
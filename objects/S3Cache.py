@@ -0,0 +1,143 @@
+import os
+import hashlib
+import threading
+import tempfile
+
+import settings
+
+
+class S3Cache:
+    '''Local disk cache for S3 objects.
+    Entries are keyed by bucket, key and ETag so a changed object is never served stale, and the same content
+    is shared across reloads, processes and re-runs of a crawl. Least recently used entries are evicted once
+    the cache grows past max_bytes (recency is tracked with file modification times). The directory is only scanned
+    for eviction when a running total of its size (taken at the first put, then added to by each put) passes
+    max_bytes, and eviction goes down to evict_to of max_bytes so the next puts do not scan again.
+    Hit and miss counts are kept per instance.
+
+    :param: directory - cache directory (defaults to settings.s3_cache_dir)
+    :param: max_bytes - size bound for the whole cache directory (defaults to settings.s3_cache_max_bytes)'''
+
+    chunk_size = 1024 * 1024
+    evict_to = 0.9
+
+    def __init__(self, directory: str = settings.s3_cache_dir, max_bytes: int = settings.s3_cache_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = None        # running total of the directory's size in bytes, None until first scanned
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.size = None        # other processes may have written since
+        self.lock = threading.Lock()
+
+    def path(self, bucket: str, key: str, etag: str) -> str:
+        '''Returns the cache path for an object version.'''
+        digest = hashlib.sha256(f'{bucket}/{key}/{etag.strip(chr(34))}'.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def count(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def lookup(self, bucket: str, key: str, etag: str):
+        '''Returns the path of a cached object (marking it as recently used) or None if it is not cached.'''
+        path = self.path(bucket, key, etag)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.count(hit=False)
+            return None
+        self.count(hit=True)
+        return path
+
+    def get(self, bucket: str, key: str, etag: str):
+        '''Returns the cached bytes of an object or None.'''
+        path = self.lookup(bucket, key, etag)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as source:
+                return source.read()
+        except FileNotFoundError:     # evicted by another process in the meantime
+            return None
+
+    def put(self, bucket: str, key: str, etag: str, content: bytes):
+        '''Stores an object's bytes.'''
+        for _ in self.put_chunks(bucket, key, etag, [content]):
+            pass
+
+    def put_chunks(self, bucket: str, key: str, etag: str, chunks):
+        '''Stores an object from an iterable of byte chunks, yielding each chunk as it is written.
+        The entry is only committed once every chunk has been written, so a partially consumed stream
+        never leaves a truncated entry behind.'''
+        path = self.path(bucket, key, etag)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        written = 0
+        try:
+            with os.fdopen(fd, 'wb') as dest:
+                for chunk in chunks:
+                    dest.write(chunk)
+                    written += len(chunk)
+                    yield chunk
+            os.replace(tmp_path, path)     # atomic, so concurrent readers never see a partial file
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self.lock:
+            if self.size is not None:
+                self.size += written
+            scan = self.size is None or self.size > self.max_bytes
+        if scan:
+            self.evict()
+
+    def iter_chunks(self, path: str):
+        '''Streams a cached file in chunks.'''
+        with open(path, 'rb') as source:
+            while chunk := source.read(self.chunk_size):
+                yield chunk
+
+    def evict(self):
+        '''Removes least recently used entries until the cache is within evict_to of max_bytes
+        (if it is over max_bytes), and resets the running total.'''
+        entries = []
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * self.evict_to:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        with self.lock:
+            self.size = total
+
+    def stats(self) -> str:
+        return f'{self.hits} hit(s), {self.misses} miss(es)'
@@ -0,0 +1,155 @@
+import os
+import pickle
+import hashlib
+import tempfile
+from urllib.parse import urlsplit
+
+import settings
+from helpers import urls as url_keys
+
+snapshot_version = 3     # bump when the way rules are stored changes, so old snapshots are not loaded
+end = ''        # marks the end of a rule in a trie node (trie edges are never empty strings)
+
+
+class ScopeMatcher:
+    '''Matches URLs against scope allow-lists.
+    Built once from the rules, then each URL is matched in time proportional to its length
+    rather than the number of rules.
+
+    - slds: hosts (e.g. gov.uk) matched on whole labels against the end of a URL's host, using a reversed-host trie.
+      i.e. gov.uk matches gov.uk, www.gov.uk and x.y.gov.uk but not notgov.uk.
+    - prefixes: domains/paths (e.g. example.gov.uk/docs) matched as string prefixes of the URL's canonical key
+      (helpers/urls.canonical: protocol, www. and fragment removed, host lower-cased), using a character trie.
+
+    :param: slds - iterable of hosts
+    :param: prefixes - iterable of URL prefixes, with or without protocol (canonicalised like the URLs matched)'''
+
+    def __init__(self, slds=(), prefixes=()):
+        self.host_trie = {}
+        self.prefix_trie = {}
+        self.rules = 0
+        for sld in slds:
+            self.add_sld(sld)
+        for prefix in prefixes:
+            self.add_prefix(prefix)
+
+    clean_url = staticmethod(url_keys.canonical)
+
+    @staticmethod
+    def insert(trie: dict, path):
+        node = trie
+        for step in path:
+            node = node.setdefault(step, {})
+        node[end] = True
+
+    def add_sld(self, sld: str):
+        sld = sld.strip().strip('.').lower()
+        if sld:
+            self.insert(self.host_trie, reversed(sld.split('.')))
+            self.rules += 1
+
+    def add_prefix(self, prefix: str):
+        prefix = self.clean_url(prefix.strip())        # rules are keyed like the URLs they match, protocol or not
+        if prefix:
+            self.insert(self.prefix_trie, prefix)
+            self.rules += 1
+
+    def host_match(self, host: str) -> bool:
+        node = self.host_trie
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+            if end in node:
+                return True
+        return False
+
+    def prefix_match(self, url: str) -> bool:
+        node = self.prefix_trie
+        for char in self.clean_url(url):
+            node = node.get(char)
+            if node is None:
+                return False
+            if end in node:
+                return True
+        return False
+
+    def match(self, url: str) -> bool:
+        '''Returns True if the URL is in scope.'''
+        if self.host_trie:
+            try:
+                host = urlsplit(url).hostname or ''
+            except ValueError:
+                host = ''
+            if self.host_match(host):
+                return True
+        return self.prefix_match(url)
+
+    def match_many(self, urls) -> list:
+        '''Matches a batch of URLs, returning a list of booleans in the same order. Repeated URLs are only matched once.'''
+        urls = list(urls)
+        results = {url: self.match(url) for url in set(urls)}
+        return [results[url] for url in urls]
+
+    def filter(self, urls) -> list:
+        '''Returns the in-scope URLs of a batch.'''
+        urls = list(urls)
+        return [url for url, matched in zip(urls, self.match_many(urls)) if matched]
+
+    @classmethod
+    def from_crawl(cls, crawl):
+        '''Builds a matcher from a Crawl's scope (Crawl.load_scope).'''
+        return cls.snapshot(prefixes=[x for x in crawl.scope if x])
+
+    @classmethod
+    def snapshot(cls, slds=(), prefixes=(), directory: str = settings.scope_snapshot_dir,
+                 max_bytes: int = settings.scope_snapshot_max_bytes):
+        '''Loads a matcher for the given rules from a pickled snapshot, building and saving it if there is none.
+        Snapshots are keyed by a hash of the rules so workers using the same lists share one, and named after
+        snapshot_version. Saving one prunes the directory (see prune_snapshots).'''
+        slds, prefixes = sorted(set(slds)), sorted(set(prefixes))
+        digest = hashlib.sha256('\n'.join(slds + ['\0'] + prefixes).encode()).hexdigest()
+        path = os.path.join(directory, f'v{snapshot_version}-{digest}.pkl')
+        try:
+            with open(path, 'rb') as source:
+                matcher = pickle.load(source)
+            os.utime(path)      # marks it as recently used
+            return matcher
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+
+        matcher = cls(slds, prefixes)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as dest:
+            pickle.dump(matcher, dest, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        prune_snapshots(directory, max_bytes)
+        return matcher
+
+
+def prune_snapshots(directory: str = settings.scope_snapshot_dir, max_bytes: int = settings.scope_snapshot_max_bytes):
+    '''Removes snapshots of other snapshot_versions, then the least recently used ones until the rest
+    are within max_bytes.'''
+    current = []
+    for entry in os.scandir(directory):
+        if not entry.name.endswith('.pkl'):
+            continue
+        try:
+            if entry.name.startswith(f'v{snapshot_version}-'):
+                stat = entry.stat()
+                current.append((stat.st_mtime, stat.st_size, entry.path))
+            else:
+                os.remove(entry.path)
+        except FileNotFoundError:       # removed by another worker in the meantime
+            pass
+
+    total = sum(size for _, size, _ in current)
+    for _, size, path in sorted(current):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+from helpers import urls
+
+check_key = 'fedcba9876543210'      # hash key of the second hash (pandas' default key makes the first)
+
+
+def hash_keys(keys: pd.Series, hash_key: str = None, chunk_size: int = 1_000_000) -> np.ndarray:
+    '''64-bit hashes of a Series of strings (vectorized, via pandas' SipHash).
+    Hashed in chunks so strings materialised from Arrow-backed Series are only held a chunk at a time.'''
+    kwargs = {'hash_key': hash_key} if hash_key else {}
+    return np.concatenate([np.zeros(0, dtype=np.uint64)] + [
+        pd.util.hash_pandas_object(keys.iloc[i:i + chunk_size], index=False, categorize=False, **kwargs).to_numpy()
+        for i in range(0, len(keys), chunk_size)])
+
+
+class URLHashSet:
+    '''Compact set of canonical URL keys (helpers/urls.canonical) for membership tests on huge crawls.
+    Keys are held as a sorted NumPy array of 64-bit hashes (plus a second, independent 64-bit hash to
+    confirm matches) instead of Python strings: 16 bytes per URL rather than ~100+.
+    Membership is a vectorized binary search (np.searchsorted).
+    Distinct keys in the set whose first hashes collide are kept as exact strings and looked up as such.
+
+    :param: keys - pandas Series of canonical URL keys'''
+
+    def __init__(self, keys: pd.Series):
+        keys = keys.reset_index(drop=True)
+        hashes = hash_keys(keys)
+        checks = hash_keys(keys, check_key)
+        order = np.lexsort((checks, hashes))
+        hashes, checks = hashes[order], checks[order]
+        duplicate = np.zeros(len(hashes), dtype=bool)     # the same key again (both hashes equal)
+        duplicate[1:] = (hashes[1:] == hashes[:-1]) & (checks[1:] == checks[:-1])
+        order, hashes, checks = order[~duplicate], hashes[~duplicate], checks[~duplicate]
+
+        repeated = np.zeros(len(hashes), dtype=bool)
+        repeated[1:] = hashes[1:] == hashes[:-1]
+        repeated[:-1] |= repeated[1:]
+        self.collisions = set(keys.iloc[order[repeated]])      # exact strings, checked when a hash is ambiguous
+        self.collided_hashes = np.unique(hashes[repeated])
+        self.hashes = hashes[~repeated]
+        self.checks = checks[~repeated]
+
+    @classmethod
+    def from_urls(cls, url_series: pd.Series):
+        '''Builds a set from raw URLs, canonicalising them first.'''
+        return cls(urls.canonical_series(url_series))
+
+    def isin(self, keys: pd.Series) -> np.ndarray:
+        '''Vectorized membership of a Series of canonical keys. Returns a boolean array in the same order.'''
+        if not len(keys):
+            return np.zeros(0, dtype=bool)
+        hashes = hash_keys(keys)
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self.hashes):
+            index = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+            found = self.hashes[index] == hashes
+            if found.any():
+                found[found] = self.checks[index[found]] == hash_keys(keys[found], check_key)
+        if self.collisions:
+            ambiguous = np.isin(hashes, self.collided_hashes)
+            found[ambiguous] = keys[ambiguous].isin(self.collisions).to_numpy()
+        return found
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self.isin(pd.Series([key]))[0])
+
+    def __len__(self) -> int:
+        return len(self.hashes) + len(self.collisions)
+
+    @property
+    def nbytes(self) -> int:
+        '''Approximate memory held by the set.'''
+        return self.hashes.nbytes + self.checks.nbytes + self.collided_hashes.nbytes + \
+            sum(len(key) + 49 for key in self.collisions)
+
+    def __repr__(self):
+        return f'<URLHashSet {len(self)} URL(s), {self.nbytes / 1024 ** 2:.1f} MB>'
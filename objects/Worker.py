@@ -0,0 +1,152 @@
+import gc
+import sys
+import time
+import multiprocessing
+
+import settings
+from helpers import logg, memory, pausing
+
+
+def reset(crawl_id: str):
+    '''Undoes the per-crawl state a job leaves in a long-lived worker: stdout/stderr redirected to the crawl's log
+    files and the crawl's logger handlers.'''
+    for stream in (sys.stdout, sys.stderr):
+        if stream not in (sys.__stdout__, sys.__stderr__) and not stream.closed:
+            stream.close()
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    logg.close_handlers(f'__main__.{crawl_id}')
+    gc.collect()
+
+
+def work(connection, target, max_jobs: int, max_rss: int, resume_event):
+    '''Worker process loop. Receives (crawl ID, time submitted) over connection, runs target(crawl ID)
+    and sends back a result dict. Its dispatch_latency is the time from the job being sent to the worker picking it
+    up: pipe and wake-up latency only, as loading the crawl counts towards runtime.
+    Exits when sent None, when the handler goes away, or after the job which takes it to max_jobs jobs or
+    max_rss bytes resident (result['recycle'] says so).
+    Pauses at checkpoints while resume_event is clear (see helpers/pausing.py).'''
+    pausing.install(resume_event)
+    process = multiprocessing.current_process()
+    name = process.name
+    jobs = 0
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        crawl_id, submitted_at = message
+        started_at = time.time()
+        process.name = f'{name}:{crawl_id}'
+        error = None
+        try:
+            target(crawl_id)
+        except Exception as e:
+            error = repr(e)
+        finally:
+            reset(crawl_id)
+            process.name = name
+        jobs += 1
+        rss = memory.rss()
+        recycle = jobs >= max_jobs or rss >= max_rss
+        connection.send({'crawl_id': crawl_id, 'error': error, 'dispatch_latency': started_at - submitted_at,
+                         'runtime': time.time() - started_at, 'rss': rss, 'jobs': jobs, 'recycle': recycle})
+        if recycle:
+            return
+
+
+class Worker:
+    '''A long-lived process which runs jobs sent to it one at a time, so jobs do not pay for process start-up and
+    imports. The worker is forked from the handler, inheriting its imported modules.
+    It is recycled (exits after reporting) after settings.worker_max_jobs jobs or once its resident memory
+    reaches settings.worker_max_rss_bytes. It can be paused, with its child processes, when memory runs short
+    (see main.ProcessHandler). Pausing is cooperative: the worker stops at its next checkpoint (helpers/pausing.py).
+
+    :param: name - process name
+    :param: target - function run with each job's crawl ID (e.g. autoQA.autoQA)'''
+
+    def __init__(self, name: str, target, max_jobs: int = settings.worker_max_jobs,
+                 max_rss: int = settings.worker_max_rss_bytes):
+        self.name = name
+        self.job = None
+        self.paused = False
+        self.paused_at = None
+        self.pausable = True
+        self.resume_event = pausing.context.Event()      # shareable with the job's forkserver pools
+        self.resume_event.set()
+        self.baseline_rss = 0
+        self.job_started = None
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=work, name=name, daemon=False,
+                                               args=(child_connection, target, max_jobs, max_rss, self.resume_event))
+        self.process.start()
+        child_connection.close()
+
+    @property
+    def idle(self) -> bool:
+        return self.job is None
+
+    @property
+    def sentinel(self):
+        return self.process.sentinel
+
+    def rss(self) -> int:
+        '''Returns the resident memory in bytes of the worker and its child processes.'''
+        return memory.tree_rss(self.process.pid)
+
+    def expected_rss(self) -> int:
+        '''Returns the memory in bytes the worker is expected to reach: what it held when its job was submitted plus
+        the job's estimated footprint (see helpers/job_cost.footprint), or what it holds now if that is more.'''
+        held = self.rss()
+        if not self.job:
+            return held
+        return max(held, self.baseline_rss + (self.job.estimated_bytes or 0))
+
+    def submit(self, job):
+        '''Sends a job (see objects/JobQueue.Job) to the worker.'''
+        self.baseline_rss = self.rss()
+        self.job_started = time.time()
+        self.pausable = True
+        self.connection.send((job.crawl_id, self.job_started))
+        self.job = job
+
+    def pause(self):
+        '''Asks the worker and its child processes to stop at their next checkpoints. Their memory is kept,
+        but stops growing.'''
+        self.resume_event.clear()
+        self.paused = True
+        self.paused_at = time.time()
+
+    def resume(self):
+        '''Lets a paused worker and its child processes carry on.'''
+        self.resume_event.set()
+        self.paused = False
+        self.paused_at = None
+
+    def result(self) -> dict:
+        '''Returns the result of the worker's job if it has finished, otherwise None.'''
+        try:
+            if self.connection.poll():
+                return self.connection.recv()
+        except (EOFError, OSError):     # the worker died; the caller checks is_alive()
+            pass
+        return None
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def close(self, timeout: float = 10):
+        '''Stops the worker (after its current job) and releases its resources.'''
+        if self.paused:
+            self.resume()
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process.close()
+        self.connection.close()
@@ -10,14 +10,15 @@ from helpers import logg
 
 process = __file__.rsplit('/', 1)[-1].replace('.py', '')  # NAME OF PROCESS
 date = datetime.datetime.now().strftime('%Y%m%d')
+inputs = ('issue', 'crawl_log', 'scope', 'crawl')  # Crawl attributes read (see template.py). 'crawl': it is pickled
+outputs = ('rud',)  # Crawl attributes set
 
 ##################################################################################################
 #### NAME FUNCTION TO MATCH MODULE NAME e.g. template.py module contains tempalte() function ####
 ##################################################################################################
 
 def CLA(crawl):
-    crawl.reload()
-
+    # The issue is not refreshed here: other processes may be using it concurrently (see autoQA.run_processes)
     check_limit = 10000
 
     process_folder = os.path.join(crawl.directory, f'{date}-{process}/')
@@ -1,24 +1,21 @@
 import os
 import sys
 import datetime
-import re
-from io import BytesIO
 import time
-from urllib.parse import urlparse
 
 from tqdm import tqdm
-import requests
-import PyPDF2
-from ratelimit import limits, sleep_and_retry
 
 import settings
 from env import secrets
-from helpers import logg
-import gwa_qa
-import gwa_aws
+from helpers import logg, s3, pdf_links, resolve, cdx
+from objects.ScopeMatcher import ScopeMatcher
+from objects.PDFLinkCache import PDFLinkCache
+from objects.CDXCache import CDXCache
 
 process = __file__.rsplit('/', 1)[-1].replace('.py', '')  # NAME OF PROCESS
 date = datetime.datetime.now().strftime('%Y%m%d')
+inputs = ('issue', 'log_store', 'warc_index')  # Crawl attributes read (see template.py)
+outputs = ()  # Crawl attributes set
 
 ###################################################################################################
 #### NAME FUNCTION TO MATCH MODULE NAME e.g. template.py module contains tempalte() function ####
@@ -37,97 +34,59 @@ def PDFflash(crawl):
     sys.stderr = open(f'{log_folder}err.log', 'a')
 
     try:
-        url_clean_regex = re.compile('^(?:.?https?:\/\/)?(?:www\.)?(.*?)/?$')
-        def clean_url(url: str):
-            '''removes URL protocol (https://www.) if there and unquotes and quotes a url'''
-            return url_clean_regex.sub(r'\1', url)
-
-        # Set Rate limit for CDX API calls.
-        MAX_CALLS_PER_SECOND = 5
-        @sleep_and_retry
-        @limits(calls=MAX_CALLS_PER_SECOND, period=1)
-        def url_in_cdx_index(url, cdx_root='https://tnaqa.mirrorweb.com/ukgwa/cdx'):
-            '''Checks the presence of a URL in the UKGWA QA CDX index. Returning True or False'''
-            try:
-                while True:
-                    processlogger.debug(f'Checking {url} in QA index.')
-                    response = requests.get(cdx_root, params={'url': url, 'limit': 1},
-                                            headers=settings.default_headers, auth=(secrets.NOTDuser, secrets.NOTDpassword)) #auth is for if using notd, does not affect other indexes
-                    processlogger.debug(f'{response.url} [{response.status_code}] {response.text}')
-                    if response.status_code == 200:
-                        return True if response.text else False
-                    else:
-                        processlogger.error(f'CDX API call failed. Trying again in 10 seconds')
-                        time.sleep(10)
-                        continue
-            except:
-                raise
-
-        url_regex = re.compile('^https?://\S+')
-        def get_urls_from_pdf(url: str):
-            '''Harvests URLs from a PDF at a given url'''
-            def get_key(object, key, otherwise=None):
-                '''x.get(a) not performing like x[a] with PyPDF2 dictionaries so naming a
-                function which replicates that behaviour'''
-                try:
-                    return object[key]
-                except:
-                    return otherwise
-
-            def get_urls_from_page(page):
-                '''Harvests URLs from a PDF page. taking a PyPDF2 page object.'''
-                annots_tag, uri_tag, ank_tag  = '/Annots', '/URI', '/A'
-                pageObject = pdfReader.getPage(page)
-                text = pageObject.extractText()
-                urls = url_regex.findall(text)
-
-                annots = get_key(pageObject, annots_tag, [])
-                for annot in annots:
-                    try:
-                        annot = annot.getObject()
-                        anks = get_key(annot, ank_tag, dict())
-                        url = get_key(anks, uri_tag, otherwise='')
-                        urls.append(url) if url_regex.match(url) else None
-                    except Exception as e:
-                        processlogger.error(e)
-                return urls
-
-            r = requests.get(url, headers=settings.default_headers)
-            pdfFileObject = BytesIO(r.content)
-            pdfReader = PyPDF2.PdfFileReader(pdfFileObject)
-
-            urls = []
-            for page in range(pdfReader.numPages):
-                urls += get_urls_from_page(page)
-
-            return urls
-
         def open_scope_list(filename: str):
             '''Opens a scope list located at s3://ENTER-YOUR-DIRECTORY/<filename>'''
-            scope = gwa_aws.open_file(settings.scope_list_bucket,
-                                              os.path.join(settings.scope_list_prefix, filename),
-                                              crawl.aws_session)
+            scope = s3.read_object(crawl.s3client, settings.scope_list_bucket,
+                                   os.path.join(settings.scope_list_prefix, filename), crawl.cache)
             scope = [x.decode() for x in scope.splitlines() if x and not x.strip().startswith(b'#')]
             return scope
 
-        # Create RUD
-        processlogger.info('Generating RUD using PDF lines.')
-        pdf_crawl_log = '\n'.join([line for line in crawl.crawl_log.split('\n') if 'application/pdf' in line])
-        crawl.pdf_rud = gwa_qa.crawl_log_rud(pdf_crawl_log)
-        processlogger.info('PDF RUD Generated.')
-
-        # Filter all URLs in crawl log for 200-399 status codes & .pdf suffix
-        pdfs = set(crawl.pdf_rud.get_urls(range(200, 400)))
+        # Filter all URLs in crawl log for 200-399 status codes & PDF mime type
+        processlogger.info('Getting PDFs from crawl log store.')
+        pdf_lines = crawl.read_crawl_log(['url', 'mime', 'digest'], [('status', '>=', 200), ('status', '<', 400)])
+        pdf_lines = pdf_lines[pdf_lines.mime.str.startswith('application/pdf', na=False)]
+        pdfs = set(pdf_lines.url)
+        digests = {url: digest for url, digest in zip(pdf_lines.url, pdf_lines.digest) if isinstance(digest, str)}
 
-        processlogger.info(f'Extracting URLs from {len(pdfs)} PDFs')
-        # Loop to extract URLs from all PDFs
+        # PDFs whose content digest has been seen before (in this or an earlier crawl) are looked up rather than parsed.
+        # Only one PDF is parsed per unseen digest.
         urls = set()
-        for pdf in tqdm(pdfs):
-            try:
-                processlogger.debug(f'Extracting URLs from {pdf}')
-                urls |= set(get_urls_from_pdf(pdf))
-            except Exception:
-                processlogger.exception(f'Failed to extract URLs from {pdf}')
+        link_cache = PDFLinkCache()
+        cached = link_cache.get_many(digests.values())
+        to_extract = {}
+        for pdf in pdfs:
+            digest = digests.get(pdf)
+            if digest in cached:
+                urls |= set(cached[digest])
+            else:
+                to_extract.setdefault(digest or pdf, pdf)
+        to_extract = list(to_extract.values())
+        processlogger.info(f'PDF link cache: {link_cache.stats()}. {len(to_extract)} PDFs to extract.')
+
+        # PDFs are read from the crawl's WARCs where possible rather than re-downloaded from the live site
+        try:
+            locations = {pdf: crawl.warc_index[pdf] for pdf in to_extract if pdf in crawl.warc_index}
+        except Exception:
+            processlogger.exception('Failed to index WARCs. Downloading PDFs from the live web.')
+            locations = {}
+        processlogger.info(f'{len(locations)} of {len(to_extract)} PDFs found in WARCs.')
+
+        processlogger.info(f'Extracting URLs from {len(to_extract)} PDFs on {settings.pdf_workers} worker(s)')
+        # PDFs are read and parsed on a process pool, URLs are merged (and cached) as results come back
+        extracted = 0
+        start = time.time()
+        results = pdf_links.extract_all(to_extract, locations, crawl.aws_session, secrets.data_bucket, logger=processlogger)
+        for pdf, pdf_urls, error in tqdm(results, total=len(to_extract)):
+            extracted += 1
+            if error:
+                processlogger.error(f'Failed to extract URLs from {pdf}: {error}')
+            else:
+                processlogger.debug(f'Extracted {len(pdf_urls)} URL(s) from {pdf}')
+                urls |= set(pdf_urls)
+                link_cache.put(digests[pdf], pdf_urls) if pdf in digests else None
+        link_cache.close()
+        pdfs_per_sec = extracted / max(time.time() - start, 1e-9)
+        processlogger.info(f'{extracted} PDFs processed in {time.time() - start:.0f}s ({pdfs_per_sec:.2f} PDFs/sec)')
 
         processlogger.info(f'Writing PDFs and URLs to crawl dir')
 
@@ -141,39 +100,38 @@ def PDFflash(crawl):
         with open(pdf_urls_path, 'w') as dest:
             dest.write('\n'.join(urls))
 
-        # Opens the three scope lists
+        # Opens the three scope lists and builds (or loads a snapshot of) the scope matcher
         scope_slds = open_scope_list('scope_allow-list_slds.txt')
         scope_domains = open_scope_list('scope_allow-list_domains.txt')
         scope_paths = open_scope_list('scope_allow-list_paths.txt')
+        scope = ScopeMatcher.snapshot(slds=scope_slds, prefixes=scope_domains+scope_paths)
 
         processlogger.info(f'Checking {len(urls)} urls against scope and QA index.')
-        patchlist = set()
-        # Runs through each URL discovered in the PDFs, checking for redirects, if they are in scope and if they are already captured
-        # (currently does not check ukgwa live collection (commented out) but checks QA index)
-        # Potential speed improvments could be made here by threading the requests.get() line and cdx index checks.
-        for url in tqdm(urls):
-            try:
-                r = requests.get(url, headers=settings.default_headers)
-                if 200 <= r.status_code < 400:
-                    url = r.url
-                    processlogger.debug(f'Checking {url} against scope')
-                    if any([domain in urlparse(url).netloc for domain in scope_slds]):
-                        pass
-                    elif any([clean_url(url).startswith(pattern) for pattern in scope_domains+scope_paths]):
-                        pass
-                    else:
-                        continue
-                    processlogger.debug(f'{url} in scope, checking QA index.')
-                    if not url_in_cdx_index(url, 'https://tnaqa.mirrorweb.com/ukgwa/cdx'):#and not url_in_cdx_index(url, 'https://webarchive.nationalarchives.gov.uk/ukgwa/cdx'):
-                        processlogger.debug(f'Adding {url} to patchlist')
-                        patchlist.add(url)
-            except Exception:
-                processlogger.exception(f'Failed checks on {url}')
+        # URLs discovered in the PDFs are resolved (following redirects) concurrently and checked against scope
+        # as each one resolves. In-scope URLs are then checked against the QA index in bulk.
+        # (currently does not check ukgwa live collection but checks QA index)
+        in_scope = set()
+        for url, status, resolved_url, error in tqdm(resolve.resolve_all(urls), total=len(urls)):
+            if error:
+                processlogger.error(f'Failed checks on {url}: {error}')
+                continue
+            if not 200 <= status < 400:
+                continue
+            processlogger.debug(f'Checking {resolved_url} against scope')
+            if scope.match(resolved_url):
+                in_scope.add(resolved_url)
+
+        processlogger.info(f'{len(in_scope)} URLs in scope, checking QA index.')
+        cdx_cache = CDXCache()
+        in_qa = cdx.check_urls(in_scope, settings.qa_cdx_root, cache=cdx_cache, logger=processlogger)
+        cdx_cache.close()
+        patchlist = {url for url in in_scope if not in_qa.get(url, False)}     # URLs which could not be checked are included
 
         processlogger.info(f'PDFflash complete. Configuring comments and attachments.')
         # Create comment and post + attachment.
         comment = 'PDF-flash:'
-        comment += f'\n{len(pdfs)} PDFs checked.'
+        comment += f'\n{len(pdfs)} PDFs checked ({len(to_extract)} parsed, {len(locations)} read from WARCs, {pdfs_per_sec:.2f} PDFs/sec).'
+        comment += f'\nPDF link cache: {link_cache.stats()}.'
         comment += f'\n{len(urls)} URLs discovered.'
         comment += f'\n{len(patchlist)} in scope and not in QA index'# or LIVE index.'
 
@@ -1,26 +1,22 @@
 import os
 import sys
 import datetime
-import time
-from urllib.parse import unquote, quote
-from io import StringIO
-import re
 
 import arrow
-import requests
 import pandas as pd
-import concurrent.futures
-from ratelimit import limits, sleep_and_retry
 
 from objects import Crawl
-from helpers import logg
-from env import secrets
-import gwa_qa
+from helpers import logg, cdx, http_client, urls, diffex_state, pausing
+from helpers.select_processes import guid_regex
+from objects.CDXCache import CDXCache
+from objects.URLHashSet import URLHashSet
 import settings
 
 
 process = __file__.rsplit('/', 1)[-1].replace('.py', '')  # NAME OF PROCESS
 date = datetime.datetime.now().strftime('%Y%m%d')
+inputs = ('issue', 'log_store')  # Crawl attributes read (see template.py)
+outputs = ('urls',)  # Crawl attributes set
 
 ###################################################################################################
 #### NAME FUNCTION TO MATCH MODULE NAME e.g. template.py module contains tempalte() function ####
@@ -42,100 +38,111 @@ def diffex(crawl: Crawl.Crawl):
     sys.stderr = open(f'{log_folder}err.log', 'a')
 
     try:
-        url_clean_regex = re.compile('^(?:.?https?:\/\/)?(?:www\.)?(.*?)/?$')
-        def clean_url(url: str):
-            '''removes URL protocol (https://www.) if there and unquotes and quotes a url'''
-            return quote(unquote(url_clean_regex.sub(r'\1', url)))
-
-        # Set Rate limit for CDX API calls.
-        MAX_CALLS_PER_SECOND = 5
-
-        @sleep_and_retry
-        @limits(calls=MAX_CALLS_PER_SECOND, period=1)
-        def url_in_cdx_index(url, cdx_root='https://tnaqa.mirrorweb.com/ukgwa/cdx'):
-            '''Checks the presence of a URL in the UKGWA QA CDX index. Returning True or False'''
-            try:
-                while True:
-                    processlogger.debug(f'Checking {url} in QA index.')
-                    response = requests.get(cdx_root, params={'url': url, 'limit': 1},
-                                            headers=settings.default_headers, auth=(secrets.NOTDuser, secrets.NOTDpassword)) #auth is for if using notd, does not affect other indexes
-                    processlogger.debug(f'{response.url} [{response.status_code}] {response.text}')
-                    if response.status_code == 200:
-                        return True if response.text else False
-                    else:
-                        processlogger.error(f'CDX API call failed. Trying again in 10 seconds')
-                        time.sleep(10)
-                        continue
-            except:
-                raise
-
-        #If there are two files with the same name, JIRA handle it by adding a guid to the filename. As such the below regex macthes ' (<guid>)' to replace it with '' when checking for diffex.csv files
-        guid_regex = re.compile(' \([0-9a-f]{8}-[0-9a-f]{4}-[1-5][0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}\)')
         ### GET DIFFEX FILE
         files = [file for file in crawl.issue.data['attachment'] if guid_regex.sub('', file['filename']).lower() == settings.diffex_filename]
         files.sort(key=lambda x: arrow.get(x['created']).datetime, reverse=True)
         file = files[0]
 
-        ### GET FILE CONTENT
-        content_response = requests.get(file['content'], auth=crawl.issue.auth, headers={'Accept': 'application/json'})
-
+        ### STREAMS FILE TO DISK (a copy of diffex.csv is kept in the process folder)
+        diffex_path = os.path.join(process_folder, 'diffex.csv')
         try:
-            assert content_response.status_code == 200
-            ### REMOVE BOM STRING IF ITS THERE
-            content = re.sub('^ï»¿', '', content_response.text)
+            size = http_client.download(file['content'], 'jira', diffex_path, auth=crawl.issue.auth,
+                                        headers={'Accept': 'application/json'})
         except Exception as e:
-            exception_message = f'Request for {settings.diffex_filename} from crawl {crawl.id} failed. '\
-                                f'[{content_response.status_code}] {content_response.text}'
-            processlogger.exception(exception_message)
+            processlogger.exception(f'Request for {settings.diffex_filename} from crawl {crawl.id} failed. {e}')
             raise
-
-        # Saves a copy of diffex.csv in the process folder
-        with open(os.path.join(process_folder, 'diffex.csv'), 'w') as dest:
-            dest.write(content)
-
-        ### Open CSV as DataFrame
-        df = pd.read_csv(StringIO(content))
-
-        # Filters the dataframe for successful requests (between 200 and 399)
-        df = df[df['Status Code'].between(200, 399)].copy()
-
-        ### Uses URL Encoded Address, cleaned and duplicates dropped
-        df.loc[:, 'clean_url'] =  df['URL Encoded Address'].apply(clean_url)
-        df.drop_duplicates('clean_url', inplace=True)
+        processlogger.info(f'{settings.diffex_filename} downloaded ({size / 1024 ** 2:.1f} MB)')
+
+        ### Reads only the status and URL columns, in chunks (utf-8-sig removes the BOM if its there)
+        reader = pd.read_csv(diffex_path, usecols=['Status Code', 'URL Encoded Address'],
+                             dtype={'Status Code': 'float64', 'URL Encoded Address': str},    # float: blank codes are NaN
+                             encoding='utf-8-sig', encoding_errors='replace', chunksize=settings.diffex_chunk_rows)
+        chunks = []
+        seen = set()
+        for chunk in reader:
+            pausing.checkpoint()
+            # Filters each chunk for successful requests (between 200 and 399)
+            chunk = chunk[chunk['Status Code'].between(200, 399) & chunk['URL Encoded Address'].notna()].copy()
+
+            ### Uses URL Encoded Address, canonicalised and duplicates (within and across chunks) dropped
+            chunk.loc[:, 'clean_url'] = urls.canonical_series(chunk['URL Encoded Address'])
+            chunk = chunk.drop_duplicates('clean_url')
+            chunk = chunk[~chunk.clean_url.isin(seen)]
+            seen.update(chunk.clean_url)
+            chunks.append(chunk)
+        del seen
+        df = pd.concat(chunks, ignore_index=True)
 
         # Saves clean, deduped SF URLs locally
         with open(os.path.join(process_folder, 'screaming-frog-urls.txt'), 'w') as dest:
             dest.write('\n'.join(df.clean_url))
 
-        # Generates RUD for crawl log
-        processlogger.info('Generating RUD.')
-        crawl.rud = gwa_qa.crawl_log_rud(crawl.crawl_log)
-        processlogger.info('RUD Generated.')
-
-        ### Cleans all URLs in Crawl log (quote and remove protocol)
-        processlogger.info('Cleaning crawl log URLs')
-        crawl.urls = set(map(clean_url, crawl.rud.get_urls(crawl.rud.present)))
-        with open(os.path.join(process_folder, 'crawl-log-urls.txt'), 'w') as dest:
-            dest.write('\n'.join(crawl.urls))
+        ### Reuses the previous run's results (see helpers/diffex_state.py)
+        ### Crawl log membership is reused if the crawl log is unchanged. Only "in QA index" verdicts are reused:
+        ### URLs missing from it may have been patched in since, so they are checked again (through the CDX cache)
+        state_path = os.path.join(crawl.directory, 'diffex-state.parquet')
+        previous, metadata = diffex_state.load(state_path)
+        fingerprint = crawl.crawl_log_fingerprint()
+        if previous is not None:
+            df = df.merge(previous[['clean_url', 'in_crawl', 'in_qa']], on='clean_url', how='left')
+        else:
+            df['in_crawl'] = df['in_qa'] = pd.array([pd.NA] * len(df), dtype='boolean')
+        if metadata.get('crawl_log_fingerprint') != fingerprint:
+            df['in_crawl'] = pd.array([pd.NA] * len(df), dtype='boolean')
+        df.loc[df.in_qa == False, 'in_qa'] = pd.NA
+        unknown = df.in_crawl.isna()
+        processlogger.info(f'{(~unknown).sum()} of {len(df)} SF URLs matched against the crawl log in a previous run')
+
+        if unknown.any() or 'crawl_url_count' not in metadata:
+            ### Canonicalises all URLs in Crawl log (quote and remove protocol)
+            processlogger.info('Cleaning crawl log URLs')
+            crawl_keys = urls.canonical_series(pd.Series(crawl.read_crawl_log(['url']).url.unique()))
+            with open(os.path.join(process_folder, 'crawl-log-urls.txt'), 'w') as dest:
+                for i in range(0, len(crawl_keys), 100000):
+                    dest.write('\n'.join(crawl_keys[i:i + 100000]) + '\n')
+
+            # Huge crawl logs are held as hashes rather than a set of strings
+            threshold = settings.diffex_hashed_url_threshold
+            hashed = threshold is not None and len(crawl_keys) >= threshold
+            crawl.urls = URLHashSet(crawl_keys) if hashed else set(crawl_keys)
+            del crawl_keys
+            processlogger.info(f'Crawl log URLs held as {crawl.urls!r}' if hashed else 'Crawl log URLs held as a set')
+            crawl_url_count = len(crawl.urls)
+
+            ### Matches new SF URLs against crawl log URLs
+            processlogger.info(f'Checking {unknown.sum()} SF URLs against crawl log URLs')
+            if hashed:
+                df.loc[unknown, 'in_crawl'] = crawl.urls.isin(df.clean_url[unknown])
+            else:
+                df.loc[unknown, 'in_crawl'] = df.clean_url[unknown].isin(crawl.urls).to_numpy()
+        else:
+            crawl_url_count = metadata['crawl_url_count']
 
         ### Return URLs missing from crawl logs
-        processlogger.info('Checking SF URLs against crawl log URLs')
-        diff = df[~df.clean_url.isin(crawl.urls)].copy()
-
-        # Checks missing URLs against QA index (multithreaded process)
-        processlogger.info(f'Checking {len(diff)} missing URLs against QA index.')
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = executor.map(url_in_cdx_index, diff['URL Encoded Address'].values)
+        missing = ~df.in_crawl.astype(bool)
+
+        # Checks missing URLs not found in the QA index by a previous run against it
+        # (bulk prefix queries for hosts with many URLs, threaded single checks otherwise)
+        unchecked = missing & df.in_qa.isna()
+        processlogger.info(f'{missing.sum()} URLs missing from crawl log. Checking {unchecked.sum()} against QA index.')
+        cdx_cache = CDXCache()
+        in_qa = cdx.check_urls(df.loc[unchecked, 'URL Encoded Address'].values, cache=cdx_cache, logger=processlogger)
+        cdx_cache.close()
+        # URLs whose check failed stay NA: they are reported as missing and checked again next run
+        df.loc[unchecked, 'in_qa'] = df.loc[unchecked, 'URL Encoded Address'].map(in_qa).astype('boolean').to_numpy()
+        if df.loc[unchecked, 'in_qa'].isna().any():
+            processlogger.warning(f'{df.loc[unchecked, "in_qa"].isna().sum()} URLs could not be checked against QA index.')
+
+        diffex_state.save(state_path, df, crawl_log_fingerprint=fingerprint, crawl_url_count=crawl_url_count)
 
         # Diff DataFrame filtered to removed URLs which are present in QA index
-        diff['in_qa'] = pd.Series(results).values
-        diff = diff[~diff.in_qa].copy()
+        diff = df[missing & ~df.in_qa.fillna(False).astype(bool)].copy()
 
         processlogger.info(f'{len(diff)} URLs missing from crawl log and QA index ')
 
         comment = f'''Diffex:
     {settings.diffex_filename} contains {len(df)} URL(s) 
-    crawl log contains {len(crawl.urls)} URL(s)
+    crawl log contains {crawl_url_count} URL(s)
     {len(diff)} URL(s) in screaming-frog log but not in crawl log or QA index.'''
 
         if not diff.empty:
@@ -6,6 +6,8 @@ from helpers import logg
 
 process = __file__.rsplit('/', 1)[-1].replace('.py', '')  # NAME OF PROCESS
 date = datetime.datetime.now().strftime('%Y%m%d')
+inputs = ('issue',)  # Crawl attributes the process reads ('crawl': the whole object e.g. if it is pickled)
+outputs = ()  # Crawl attributes the process sets. Processes which do not conflict run concurrently (see autoQA.conflicts)
 
 ###################################################################################################
 #### NAME FUNCTION TO MATCH MODULE NAME e.g. template.py module contains tempalte() function ####
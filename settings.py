@@ -6,13 +6,114 @@ root = os.path.dirname(os.path.realpath(__file__))
 aqa_dir = os.path.join(home, 'aqa-crawls/')
 aqa_queue = os.path.join(aqa_dir, 'queue/')
 aqa_running = os.path.join(aqa_dir, 'running/')
+s3_cache_dir = os.path.join(aqa_dir, 'cache/s3/')
+scope_snapshot_dir = os.path.join(aqa_dir, 'cache/scope/')
+pdf_link_cache_path = os.path.join(aqa_dir, 'cache/pdf-links.sqlite')
+cdx_cache_path = os.path.join(aqa_dir, 'cache/cdx.sqlite')
+rate_limit_dir = os.path.join(aqa_dir, 'rate-limits/')
+job_queue_path = os.path.join(aqa_queue, 'jobs.sqlite')
 
-os.system(f'mkdir -p {aqa_dir} {aqa_queue}')# {aqa_running}')
+os.system(f'mkdir -p {aqa_dir} {aqa_queue} {s3_cache_dir}')# {aqa_running}')
 
 diffex_filename = 'diffex.csv'
 
+s3_max_workers = 16     # Threads used for parallel S3 downloads
+s3_cache_max_bytes = 50 * 1024 ** 3     # Size bound of the local S3 cache (least recently used entries evicted first)
+scope_snapshot_max_bytes = 2 * 1024 ** 3     # Size bound of the scope matcher snapshots (least recently used removed first)
+
+# Crawl WARCs and CDX indexes are under <prefix>tna-<crawl id> in the data bucket (like crawl-logs/)
+warc_prefix = 'warcs/'
+cdx_prefix = 'cdx/'
+
 scope_list_bucket = 'tna-ukgwa-sharing'
 scope_list_prefix = 'scope-lists/'
 
+# PDFflash link extraction
+pdf_workers = 4                         # Processes downloading and parsing PDFs
+pdf_timeout = 300                       # Seconds allowed per PDF (download and parse)
+pdf_worker_memory_bytes = 1024 ** 3     # Address space each worker may grow by before a PDF is abandoned
+pdf_max_tasks_per_worker = 100          # Workers are recycled after this many PDFs
+pdf_max_bytes = 250 * 1024 ** 2         # Larger PDFs are skipped
+pdf_spool_bytes = 16 * 1024 ** 2        # PDFs are held in memory up to this size, then spilled to a temporary file
+
+# Redirect resolution for URLs discovered in PDFs
+resolve_concurrency = 50                # Requests in flight at once
+resolve_per_host = 4                    # Requests in flight per host
+resolve_timeout = 60                    # Seconds per request
+
+# CDX index checks
+qa_cdx_root = 'https://tnaqa.mirrorweb.com/ukgwa/cdx'
+cdx_bulk_threshold = 200                # Hosts with at least this many URLs to check are fetched with one prefix query
+cdx_bulk_captures_per_url = 50          # Prefixes with more captures than this per URL checked are split by directory
+cdx_captures_per_page = 30000           # Estimated captures per page of a paginated CDX server (at least one page is read)
+cdx_cache_positive_ttl = 30 * 24 * 3600 # Seconds a cached "in index" answer is trusted
+cdx_cache_negative_ttl = 24 * 3600      # Seconds a cached "not in index" answer is trusted
+
+# Sub-processes of one crawl
+subprocess_concurrency = 3              # Sub-processes run at once (those which do not conflict, see autoQA.conflicts)
+
+# Queue
+job_max_attempts = 3                    # Runs of a job whose worker died before it is marked failed
+queue_poll_seconds = 5                  # Queue polling interval if the queue directory cannot be watched (inotify)
+queue_wait_seconds = 300                # Longest wait for a queue/process event before rechecking anyway
+worker_max_jobs = 20                    # Crawls a worker runs before it is replaced
+worker_max_rss_bytes = 4 * 1024 ** 3    # Workers whose resident memory reaches this after a crawl are replaced
+
+# Queued crawls are scheduled shortest expected job first (see helpers/job_cost.py), with aging and a starvation cap
+job_aging = 2                           # Seconds of estimated runtime forgiven per second a job has waited
+job_max_wait = 24 * 3600                # Jobs waiting longer than this run next, oldest first
+job_large_seconds = 4 * 3600            # Jobs estimated to take longer than this are large
+job_large_share = 0.5                   # Fraction of workers large jobs may occupy (at least one)
+job_cost_model = {                      # Linear runtime model (seconds). Compare with the predicted/actual runtimes logged
+    'base': 60,
+    'default_crawl_log_bytes': 1024 ** 3,
+    'pdfs_per_crawl_log_gb': 2000,
+    'CLA': {'base': 120, 'per_crawl_log_gb': 1800},
+    'preCLA': {'base': 60, 'per_crawl_log_gb': 1200},
+    'diffex': {'base': 60, 'per_crawl_log_gb': 300, 'per_diffex_gb': 1200},
+    'PDFflash': {'base': 60, 'per_crawl_log_gb': 120, 'per_pdf': 1.5},
+}
+
+# Memory admission control: crawls are only dispatched while their estimated footprint fits the budget
+memory_budget_bytes = None              # Bytes the workers and listener may hold between them (None: a fraction of MemTotal)
+memory_budget_fraction = 0.8            # Fraction of MemTotal used as the budget if memory_budget_bytes is None
+memory_min_available_bytes = 1024 ** 3  # MemAvailable kept free: below it no crawl is dispatched and busy workers are paused
+memory_pause_fraction = 0.95            # Busy workers are paused (at their next checkpoint), newest first, once they hold this fraction of the budget
+memory_resume_fraction = 0.8            # Paused workers are resumed, oldest first, once held memory is back below this
+memory_pause_max_seconds = 30 * 60      # Workers paused for longer than this are resumed regardless
+memory_check_seconds = 10               # Interval memory is checked at while crawls are running
+job_memory_model = {                    # Linear model of a crawl's peak memory (bytes) over an idle worker's, like job_cost_model
+    'base': 256 * 1024 ** 2,
+    'default_crawl_log_bytes': 1024 ** 3,
+    'CLA': {'per_crawl_log_byte': 4},   # the concatenated crawl log, its DataFrame and the RUD
+    'preCLA': {'per_crawl_log_byte': 4},
+    'diffex': {'base': 512 * 1024 ** 2, 'per_crawl_log_byte': 0.5},
+    'PDFflash': {'base': pdf_workers * 256 * 1024 ** 2, 'per_crawl_log_byte': 0.5},
+}
+
+# URL canonicalisation (helpers/urls)
+url_cache_size = 2 ** 20                # URLs whose canonical key is memoised per process
+
+# diffex
+diffex_hashed_url_threshold = 5_000_000 # Crawl logs with at least this many URLs are held as a URLHashSet (None: always a set)
+diffex_chunk_rows = 500_000             # diffex.csv rows parsed at a time
+diffex_state_max_age = 7 * 24 * 3600    # Seconds a previous run's results are reused for (crawl log matches and QA index verdicts)
+
+# Requests per second shared by all autoQA processes, per endpoint
+rate_limits = {'cdx': 5, 'jira': 5, 'live': 20}
+adaptive_rate_limits = ('cdx', 'jira')  # Rates halved on 429/5xx. Not 'live': it spans every site, so one failing host would slow the rest
+rate_limit_min_fraction = 0.05          # The rate is never reduced below this fraction of its limit
+rate_limit_recovery = 0.01              # Fraction of the limit the rate climbs by per successful response
+
+# Shared HTTP client
+http_timeout = 60                       # Seconds (connect and read) per request unless a caller sets its own
+http_retries = 5                        # Retries for connection errors, timeouts, 429s and 5xx responses
+http_backoff_base = 1                   # Seconds, doubled each retry (with jitter)
+http_backoff_max = 60
+http_pool_hosts = 50                    # Hosts with pooled keep-alive connections
+http_pool_size = 20                     # Connections kept per host
+circuit_failures = 10                   # Consecutive failures before an endpoint's circuit opens
+circuit_reset_seconds = 60              # Seconds before a trial request is let through an open circuit
+
 default_headers = {'user-agent': 'UKGWA autoQA bot:www.nationalarchives.gov.uk/webarchive/; webarchive@nationalarchives.gov.uk'}
 
@@ -0,0 +1,16 @@
+import os
+import sys
+import types
+import tempfile
+
+# settings imports the private env.secrets and creates directories under ~/aqa-crawls on import,
+# so tests get a stand-in env module and a temporary home directory before anything imports it.
+os.environ['HOME'] = tempfile.mkdtemp(prefix='aqa-tests-')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+secrets = types.SimpleNamespace(JIRAauth=None, NOTDuser='', NOTDpassword='', S3ACCESS_KEY='', S3SECRET_KEY='',
+                                data_bucket='data-bucket', report_to_account_ID='')
+env = types.ModuleType('env')
+env.secrets = secrets
+sys.modules.setdefault('env', env)
+sys.modules.setdefault('env.secrets', secrets)
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from objects.ScopeMatcher import ScopeMatcher, snapshot_version
+
+
+@pytest.mark.parametrize('rule, url', [
+    ('example.org.uk/search?q=x', 'https://example.org.uk/search?q=x'),
+    ('www.example.gov.uk/docs/', 'http://www.example.gov.uk/docs/report.pdf'),
+    ('Example.com/a b', 'https://example.com/a%20b'),
+    ('https://www.example.gov.uk/', 'https://example.gov.uk/page'),
+])
+def test_rule_matches_its_own_url(rule, url):
+    matcher = ScopeMatcher(prefixes=[rule])
+    assert matcher.match(rule)
+    assert matcher.match(url)
+
+
+def test_rule_does_not_match_other_hosts():
+    matcher = ScopeMatcher(prefixes=['example.gov.uk/docs'])
+    assert not matcher.match('https://other.gov.uk/docs')
+
+
+def test_snapshot_prunes_stale_versions_and_least_recently_used(tmp_path):
+    stale = tmp_path / 'v0-abc.pkl'
+    stale.write_bytes(b'old')
+    first = ScopeMatcher.snapshot(prefixes=['a.gov.uk/'], directory=str(tmp_path))
+    assert not stale.exists()
+    assert first.match('https://a.gov.uk/x')
+    [first_path] = os.listdir(tmp_path)
+    assert first_path.startswith(f'v{snapshot_version}-')
+
+    size = os.path.getsize(tmp_path / first_path)
+    os.utime(tmp_path / first_path, (0, 0))
+    ScopeMatcher.snapshot(prefixes=['b.gov.uk/'], directory=str(tmp_path), max_bytes=size * 3 // 2)
+    assert len(os.listdir(tmp_path)) == 1 and first_path not in os.listdir(tmp_path)
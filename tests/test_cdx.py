@@ -0,0 +1,132 @@
+import math
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+import settings
+from helpers import cdx
+from helpers.urls import canonical
+from objects.RateLimiter import RateLimiter
+
+
+class StubCDX(BaseHTTPRequestHandler):
+    '''CDX API stub answering url (exact or matchType=prefix), showNumPages, page and fl=original queries
+    from the server's captures. Paginated servers serve page_size captures per page; others ignore paging.'''
+
+    def do_GET(self):
+        server = self.server
+        params = {name: values[0] for name, values in parse_qs(urlsplit(self.path).query).items()}
+        server.requests.append(params)
+        url = params['url']
+        if url in server.failing:
+            return self.answer(400, b'')
+        if params.get('matchType') == 'prefix':
+            matched = [x for x in server.captures if canonical(x).startswith(url)]
+        else:
+            matched = [x for x in server.captures if canonical(x) == canonical(url)][:int(params.get('limit', 1))]
+        if server.page_size and params.get('showNumPages') == 'true':
+            return self.answer(200, f'{math.ceil(len(matched) / server.page_size)}\n'.encode())
+        if server.page_size and 'page' in params:
+            page = int(params['page'])
+            matched = matched[page * server.page_size:(page + 1) * server.page_size]
+        lines = [x if params.get('fl') == 'original' else f'{canonical(x)} 20200101000000 {x} text/html 200'
+                 for x in matched]
+        self.answer(200, ''.join(f'{line}\n' for line in lines).encode())
+
+    def answer(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    '''Starts a stub CDX server (with no rate limit), returning a function which sets its captures and paging.'''
+    monkeypatch.setitem(settings.rate_limits, 'cdx', 100000)
+    monkeypatch.setattr(RateLimiter, 'registry', {})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCDX)
+    server.requests, server.failing = [], set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def configure(captures: list, page_size: int = None):
+        server.captures, server.page_size = captures, page_size
+        server.root = f'http://127.0.0.1:{server.server_port}/cdx'
+        return server
+    yield configure
+    server.shutdown()
+    server.server_close()
+
+
+def prefix_queries(server) -> list:
+    return [x['url'] for x in server.requests if x.get('matchType') == 'prefix' and 'showNumPages' not in x]
+
+
+def single_queries(server) -> list:
+    return [x['url'] for x in server.requests if x.get('matchType') != 'prefix']
+
+
+def test_single_checks_below_bulk_threshold(stub):
+    server = stub(['https://a.gov.uk/1', 'https://a.gov.uk/3'])
+    urls = [f'http://a.gov.uk/{i}' for i in range(4)]
+    assert cdx.check_urls(urls, server.root, bulk_threshold=5) == {
+        'http://a.gov.uk/0': False, 'http://a.gov.uk/1': True, 'http://a.gov.uk/2': False, 'http://a.gov.uk/3': True}
+    assert not prefix_queries(server)
+    assert len(single_queries(server)) == 4
+
+
+@pytest.mark.parametrize('page_size', [None, 3])
+def test_bulk_prefix_query_at_bulk_threshold(stub, monkeypatch, page_size):
+    monkeypatch.setattr(settings, 'cdx_captures_per_page', page_size or 3)
+    captures = [f'https://www.a.gov.uk/docs/{i}' for i in range(0, 10, 2)]
+    server = stub(captures, page_size)
+    urls = [f'http://a.gov.uk/docs/{i}' for i in range(5)]
+    results = cdx.check_urls(urls, server.root, bulk_threshold=5)
+    assert results == {url: int(url.rsplit('/', 1)[1]) % 2 == 0 for url in urls}
+    assert set(prefix_queries(server)) == {'a.gov.uk/docs/'}
+    assert not single_queries(server)
+    pages = [x.get('page') for x in server.requests if x.get('matchType') == 'prefix' and 'showNumPages' not in x]
+    assert pages == (['0', '1'] if page_size else [None])
+
+
+def test_non_paginated_server_probed_once(stub):
+    server = stub([f'https://a.gov.uk/{d}/{i}' for d in 'xy' for i in range(5)])
+    urls = [f'http://a.gov.uk/{d}/{i}' for d in 'xy' for i in range(5)]
+    cdx.check_urls(urls[:5], server.root, bulk_threshold=5)
+    cdx.check_urls(urls[5:], server.root, bulk_threshold=5)
+    assert len([x for x in server.requests if 'showNumPages' in x]) == 1
+
+
+@pytest.mark.parametrize('page_size', [None, 3])
+def test_broad_prefix_split_by_directory(stub, monkeypatch, page_size):
+    monkeypatch.setattr(settings, 'cdx_bulk_captures_per_url', 2)
+    monkeypatch.setattr(settings, 'cdx_captures_per_page', 3)
+    captures = [f'https://a.gov.uk/big/{i}' for i in range(100)]
+    captures += [f'https://a.gov.uk/docs/{i}' for i in range(5)] + [f'https://a.gov.uk/news/{i}' for i in range(5)]
+    server = stub(captures, page_size)
+    urls = [f'http://a.gov.uk/docs/{i}' for i in range(5)] + [f'http://a.gov.uk/news/{i}' for i in range(5, 10)]
+    urls += ['http://a.gov.uk/top']
+    results = cdx.check_urls(urls, server.root, bulk_threshold=5)
+    assert results == {url: '/docs/' in url for url in urls}
+    assert set(prefix_queries(server)) == {'a.gov.uk/docs/', 'a.gov.uk/news/'} | (set() if page_size else {'a.gov.uk/'})
+    assert single_queries(server) == ['http://a.gov.uk/top']
+
+
+def test_failed_prefix_query_falls_back_to_single_checks(stub):
+    server = stub([f'https://a.gov.uk/docs/{i}' for i in range(3)])
+    server.failing.add('a.gov.uk/docs/')
+    urls = [f'http://a.gov.uk/docs/{i}' for i in range(5)]
+    assert cdx.check_urls(urls, server.root, bulk_threshold=5) == {url: url[-1] in '012' for url in urls}
+    assert sorted(single_queries(server)) == sorted(urls)
+
+
+def test_failed_single_check_is_left_out(stub):
+    server = stub(['https://a.gov.uk/1'])
+    server.failing.add('http://a.gov.uk/2')
+    urls = ['http://a.gov.uk/1', 'http://a.gov.uk/2', 'http://a.gov.uk/3']
+    assert cdx.check_urls(urls, server.root, bulk_threshold=5) == {'http://a.gov.uk/1': True, 'http://a.gov.uk/3': False}
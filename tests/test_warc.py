@@ -0,0 +1,139 @@
+import io
+import gzip
+import json
+import zlib
+
+import pytest
+
+from helpers import warc
+
+
+class FakeS3:
+    '''Serves objects from a dict of key: bytes, honouring ranged reads like S3 get_object.'''
+
+    def __init__(self, objects: dict):
+        self.objects = objects
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None):
+        data = self.objects[Key]
+        if Range:
+            start, end = map(int, Range.replace('bytes=', '').split('-'))
+            data = data[start:end + 1]
+        return {'Body': io.BytesIO(data)}
+
+
+def response_record(url: str, body: bytes, http_headers: dict = None) -> bytes:
+    '''Builds an uncompressed WARC response record.'''
+    http = b'HTTP/1.1 200 OK\r\n' + b''.join(f'{name}: {value}\r\n'.encode() for name, value in (http_headers or {}).items())
+    block = http + b'\r\n' + body
+    warc_headers = (f'WARC/1.0\r\nWARC-Type: response\r\nWARC-Target-URI: {url}\r\n'
+                    f'Content-Length: {len(block)}\r\n\r\n').encode()
+    return warc_headers + block + b'\r\n\r\n'
+
+
+def chunked(body: bytes, size: int = 7) -> bytes:
+    chunks = [body[i:i + size] for i in range(0, len(body), size)]
+    return b''.join(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n' for chunk in chunks) + b'0\r\n\r\n'
+
+
+def warc_gz(records: list) -> tuple:
+    '''Builds a .warc.gz of one gzip member per record, returning (bytes, [(offset, length)]).'''
+    data, locations = b'', []
+    for record in records:
+        member = gzip.compress(record)
+        locations.append((len(data), len(member)))
+        data += member
+    return data, locations
+
+
+@pytest.fixture
+def archive():
+    pdf = b'%PDF-1.4 ' + bytes(range(256)) * 40
+    records = [response_record('http://a.gov.uk/', b'<html></html>', {'Content-Type': 'text/html'}),
+               response_record('http://a.gov.uk/x.pdf', pdf, {'Content-Type': 'application/pdf'})]
+    data, locations = warc_gz(records)
+    return FakeS3({'warcs/crawl-1.warc.gz': data}), locations, records, pdf
+
+
+def test_parse_cdx_line_cdx11():
+    line = 'uk,gov,a)/x.pdf 20200101000000 http://a.gov.uk/x.pdf application/pdf 200 ABC - - 1234 567 crawl-1.warc.gz'
+    assert warc.parse_cdx_line(line) == ('http://a.gov.uk/x.pdf', '200', 'application/pdf', 1234, 567, 'crawl-1.warc.gz')
+
+
+def test_parse_cdx_line_cdxj():
+    record = {'url': 'http://a.gov.uk/x.pdf', 'status': '200', 'mime': 'application/pdf',
+              'length': '1234', 'offset': '567', 'filename': 'crawl-1.warc.gz'}
+    line = f'uk,gov,a)/x.pdf 20200101000000 {json.dumps(record)}'
+    assert warc.parse_cdx_line(line) == ('http://a.gov.uk/x.pdf', '200', 'application/pdf', 1234, 567, 'crawl-1.warc.gz')
+
+
+def test_parse_cdx_line_skips_headers_and_malformed_lines():
+    assert warc.parse_cdx_line(' CDX N b a m s k r M S V g') is None
+    assert warc.parse_cdx_line('uk,gov,a)/ 2020 too few fields') is None
+
+
+def test_build_index():
+    lines = [
+        'uk,gov,a)/ 2020 http://a.gov.uk/ text/html 200 A - - 10 0 crawl-1.warc.gz',
+        'uk,gov,a)/x.pdf 2020 http://a.gov.uk/x.pdf application/pdf 200 B - - 20 10 crawl-1.warc.gz',
+        'uk,gov,a)/y.pdf 2020 http://a.gov.uk/y.pdf application/pdf 404 C - - 30 30 crawl-1.warc.gz',
+        'uk,gov,a)/z.pdf 2020 http://a.gov.uk/z.pdf application/pdf 200 D - - 40 60 unknown.warc.gz',
+        'uk,gov,a)/x.pdf 2021 http://a.gov.uk/x.pdf application/pdf 200 E - - 50 100 /data/crawl-2.warc.gz',
+    ]
+    keys = ['warcs/tna-1/crawl-1.warc.gz', 'warcs/tna-1/crawl-2.warc.gz']
+    assert warc.build_index(lines, keys) == {'http://a.gov.uk/': ('warcs/tna-1/crawl-1.warc.gz', 0, 10),
+                                             'http://a.gov.uk/x.pdf': ('warcs/tna-1/crawl-2.warc.gz', 100, 50)}
+    assert warc.build_index(lines, keys, mimes=('application/pdf',)) == {
+        'http://a.gov.uk/x.pdf': ('warcs/tna-1/crawl-2.warc.gz', 100, 50)}
+
+
+def test_read_record_reads_one_gzip_member(archive):
+    s3, locations, records, _ = archive
+    offset, length = locations[1]
+    assert warc.read_record(s3, 'bucket', 'warcs/crawl-1.warc.gz', offset, length) == records[1]
+
+
+def test_read_record_rejects_large_records(archive):
+    s3, locations, records, _ = archive
+    offset, length = locations[1]
+    with pytest.raises(warc.PayloadTooLarge):
+        warc.read_record(s3, 'bucket', 'warcs/crawl-1.warc.gz', offset, length, io.BytesIO(), max_bytes=100)
+
+
+def test_record_payload_plain():
+    headers, body = warc.record_payload(response_record('http://a.gov.uk/', b'hello', {'Content-Type': 'text/plain'}))
+    assert headers['content-type'] == 'text/plain'
+    assert body == b'hello'
+
+
+def test_record_payload_chunked():
+    body = b'a PDF body split into several chunks'
+    record = response_record('http://a.gov.uk/x.pdf', chunked(body), {'Transfer-Encoding': 'chunked'})
+    assert warc.record_payload(record)[1] == body
+
+
+def test_record_payload_gzip_content_encoding():
+    body = b'%PDF-1.4 compressed on the wire' * 100
+    record = response_record('http://a.gov.uk/x.pdf', gzip.compress(body), {'Content-Encoding': 'gzip'})
+    assert warc.record_payload(record)[1] == body
+
+
+def test_record_payload_chunked_and_deflate():
+    body = b'%PDF-1.4 deflated and chunked' * 100
+    record = response_record('http://a.gov.uk/x.pdf', chunked(zlib.compress(body), 100),
+                             {'Transfer-Encoding': 'chunked', 'Content-Encoding': 'deflate'})
+    assert warc.record_payload(record)[1] == body
+
+
+def test_fetch_payload(archive):
+    s3, locations, _, pdf = archive
+    with warc.fetch_payload(s3, 'bucket', ('warcs/crawl-1.warc.gz', *locations[1]), spool_bytes=1024) as payload:
+        assert payload.read() == pdf
+
+
+def test_fetch_payload_bounds_decompressed_bodies():
+    bomb = gzip.compress(b'\0' * 10 * 1024 ** 2)      # ~10 KB on the wire, 10 MB decompressed
+    data, locations = warc_gz([response_record('http://a.gov.uk/x.pdf', bomb, {'Content-Encoding': 'gzip'})])
+    s3 = FakeS3({'warcs/crawl-1.warc.gz': data})
+    with pytest.raises(warc.PayloadTooLarge):
+        warc.fetch_payload(s3, 'bucket', ('warcs/crawl-1.warc.gz', *locations[0]), max_bytes=1024 ** 2)